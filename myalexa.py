@@ -12,7 +12,6 @@ import os
 import re
 import time
 import locale
-import pigpio
 import socket
 import signal, atexit, subprocess, traceback
 import threading
@@ -41,9 +40,9 @@ class device_handler(debounce_handler, MyLog):
         self.LogInfo("--> State " + str(state) + " on " + name + " from client @ " + client_address)
         shutterId = self.config.ShuttersByName[name]
         if state:
-           self.shutter.lower(shutterId)
+           self.shutter.lower(shutterId, source = 'alexa')
         else:
-           self.shutter.rise(shutterId)
+           self.shutter.rise(shutterId, source = 'alexa')
         return True
 
 
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, os, struct, calendar
+import datetime
+import threading
+from array import array
+
+try:
+    import ephem
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+#------------ AstroCache class ------------------------------------------------
+# Sunrise, sunset and civil twilight (dawn and dusk) of every day of a year,
+# computed with ephem in one pass for the location and kept in a table with
+# one row per day of the year, so looking up a day is an index. The tables
+# are saved to a file and only computed again for a new year or when the
+# location changes.
+#
+# A row holds the seconds from 0:00 UTC of the day to each event, as ephem's
+# next rising/setting after that time; -1 if the sun does not rise or set.
+class AstroCache(MyLog):
+    Magic = b'RTSASTR1'
+    HeaderFormat = '>ddiI'      # latitude, longitude, year, days
+    Events = ('sunrise', 'sunset', 'dawn', 'dusk')
+    CivilTwilight = '-6'
+
+    #---------------------AstroCache::__init__----------------------------------
+    def __init__(self, filename = None, log = None):
+        super(AstroCache, self).__init__()
+        if log != None:
+            self.log = log
+        self.FileName = filename
+        self.lock = threading.Lock()
+        self.tables = {}    # (latitude, longitude, year) -> array of days * len(Events) seconds
+        self.loaded = False
+        self.computations = 0
+
+    #---------------------AstroCache::getSunTimes-------------------------------
+    # {'sunrise': datetime, 'sunset': ..., 'dawn': ..., 'dusk': ...} of day (a
+    # datetime.date), local times, None for an event which does not happen
+    def getSunTimes(self, day, latitude, longitude):
+        table = self.getTable(day.year, latitude, longitude)
+        row = (day.timetuple().tm_yday - 1) * len(self.Events)
+        midnight = calendar.timegm(day.timetuple())
+        times = {}
+        for i, event in enumerate(self.Events):
+            seconds = table[row + i]
+            times[event] = datetime.datetime.fromtimestamp(midnight + seconds) if seconds >= 0 else None
+        return times
+
+    #---------------------AstroCache::getTable----------------------------------
+    def getTable(self, year, latitude, longitude):
+        key = (round(float(latitude), 6), round(float(longitude), 6), year)
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                try:
+                    self.load()
+                except Exception as e1:
+                    self.LogError("Error reading astro table from " + str(self.FileName) + ": " + str(e1))
+            if key in self.tables:
+                return self.tables[key]
+
+            self.LogInfo("Computing sunrise and sunset of " + str(year) + " for " + str(key[0]) + " / " + str(key[1]))
+            self.tables[key] = self.compute(year, key[0], key[1])
+            # only the tables of the current location are kept
+            self.tables = {k: v for k, v in self.tables.items() if k[:2] == key[:2] and k[2] >= year - 1}
+            try:
+                self.save()
+            except Exception as e1:
+                self.LogError("Error writing astro table to " + str(self.FileName) + ": " + str(e1))
+            return self.tables[key]
+
+    #---------------------AstroCache::compute-----------------------------------
+    def compute(self, year, latitude, longitude):
+        observer = ephem.Observer()
+        observer.lat = str(latitude)
+        observer.lon = str(longitude)
+        sun = ephem.Sun()
+        days = 366 if calendar.isleap(year) else 365
+        table = array('i', [-1]) * (days * len(self.Events))
+        for day in range(days):
+            midnight = ephem.Date(datetime.datetime(year, 1, 1) + datetime.timedelta(days = day))
+            for i, (horizon, useCenter, rising) in enumerate((('0', False, True), ('0', False, False), (self.CivilTwilight, True, True), (self.CivilTwilight, True, False))):
+                observer.date = midnight
+                observer.horizon = horizon
+                try:
+                    if rising:
+                        eventTime = observer.next_rising(sun, use_center = useCenter)
+                    else:
+                        eventTime = observer.next_setting(sun, use_center = useCenter)
+                except (ephem.AlwaysUpError, ephem.NeverUpError):
+                    continue
+                table[day * len(self.Events) + i] = int(round((eventTime - midnight) * 86400))
+        self.computations += 1
+        return table
+
+    #---------------------AstroCache::load--------------------------------------
+    def load(self):
+        if (self.FileName == None) or not os.path.isfile(self.FileName):
+            return
+        with open(self.FileName, "rb") as f:
+            data = f.read()
+        if data[:len(self.Magic)] != self.Magic:
+            self.LogWarn("Not an astro table file, ignoring it: " + self.FileName)
+            return
+        offset = len(self.Magic)
+        headerSize = struct.calcsize(self.HeaderFormat)
+        while offset + headerSize <= len(data):
+            latitude, longitude, year, days = struct.unpack_from(self.HeaderFormat, data, offset)
+            offset += headerSize
+            table = array('i')
+            length = days * len(self.Events) * table.itemsize
+            if offset + length > len(data):
+                self.LogWarn("Truncated astro table file, ignoring the rest: " + self.FileName)
+                break
+            table.frombytes(data[offset:offset + length])
+            offset += length
+            self.tables[(latitude, longitude, year)] = table
+
+    #---------------------AstroCache::save--------------------------------------
+    def save(self):
+        if self.FileName == None:
+            return
+        data = [self.Magic]
+        for (latitude, longitude, year), table in self.tables.items():
+            data.append(struct.pack(self.HeaderFormat, latitude, longitude, year, len(table) // len(self.Events)))
+            data.append(table.tobytes())
+        temporary = self.FileName + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.FileName)
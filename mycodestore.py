@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, os, struct, zlib
+import threading
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+#------------ RollingCodeStore class ------------------------------------------
+# Rolling codes are kept in a small binary file with one fixed size record per
+# remote address, instead of rewriting the config file on every button press.
+#
+# Every record has two slots (address, reserved code, sequence, crc32). The
+# slot holding the older sequence is overwritten, so a write interrupted by a
+# power loss can only damage one slot and the other one is still valid.
+#
+# Codes are reserved ahead: the stored value is the first code that has NOT
+# been handed out yet, and it is only written again once all codes of the
+# reserved block have been used. After a power loss the unused rest of the
+# block is skipped, so a code is never sent twice.
+class RollingCodeStore(MyLog):
+    Magic = b'RTSCODE1'
+    SlotFormat = '>IIII'
+    SlotSize = struct.calcsize(SlotFormat)
+    RecordSize = 2 * SlotSize
+    # codes skipped for a shutter whose record may have been lost, its last
+    # code is not known
+    RecoverySkip = 1000
+
+    #---------------------RollingCodeStore::__init__----------------------------
+    def __init__(self, filename, reserve = 16, log = None):
+        super(RollingCodeStore, self).__init__()
+        if log != None:
+            self.log = log
+        self.FileName = filename
+        self.Reserve = max(1, int(reserve))
+        self.lock = threading.Lock()
+        self.fd = None
+        self.records = {}   # address -> [record index, reserved code, sequence]
+        self.recordCount = 0    # records in the file, valid or not
+        self.corruptRecords = 0
+        self.codes = {}     # address -> next code to send
+        self.writes = 0
+
+    #---------------------RollingCodeStore::open--------------------------------
+    def open(self):
+        with self.lock:
+            created = not os.path.isfile(self.FileName)
+            self.fd = os.open(self.FileName, os.O_RDWR | os.O_CREAT, 0o644)
+            if created or os.fstat(self.fd).st_size < len(self.Magic):
+                os.pwrite(self.fd, self.Magic, 0)
+                os.fsync(self.fd)
+                self.syncDirectory()
+            elif os.pread(self.fd, len(self.Magic), 0) != self.Magic:
+                raise Exception("Not a rolling code file: " + self.FileName)
+
+            data = os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+            count = (len(data) - len(self.Magic)) // self.RecordSize
+            self.recordCount = count
+            for index in range(count):
+                offset = len(self.Magic) + index * self.RecordSize
+                best = None
+                for slot in range(2):
+                    address, code, sequence, crc = struct.unpack_from(self.SlotFormat, data, offset + slot * self.SlotSize)
+                    if (crc != zlib.crc32(data[offset + slot * self.SlotSize:offset + slot * self.SlotSize + 12])) or (sequence == 0):
+                        continue
+                    if (best == None) or (sequence > best[2]):
+                        best = (address, code, sequence)
+                if best == None:
+                    self.LogWarn("Rolling code record " + str(index) + " is corrupt, ignoring it")
+                    self.corruptRecords += 1
+                    continue
+                self.records[best[0]] = [index, best[1], best[2]]
+                # whatever was reserved before the restart may have been sent
+                self.codes[best[0]] = best[1]
+        return True
+
+    #---------------------RollingCodeStore::syncDirectory-----------------------
+    def syncDirectory(self):
+        try:
+            dirfd = os.open(os.path.dirname(os.path.abspath(self.FileName)), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            pass
+
+    #---------------------RollingCodeStore::writeRecord-------------------------
+    # Must be called with self.lock held, the caller does the fsync
+    def writeRecord(self, address, reserved):
+        if address in self.records:
+            index, oldReserved, sequence = self.records[address]
+        else:
+            # appended, a corrupt record keeps its place
+            index = self.recordCount
+            self.recordCount += 1
+            sequence = 0
+        sequence += 1
+        slotData = struct.pack('>III', address, reserved, sequence)
+        slotData += struct.pack('>I', zlib.crc32(slotData))
+        offset = len(self.Magic) + index * self.RecordSize + (sequence % 2) * self.SlotSize
+        os.pwrite(self.fd, slotData, offset)
+        self.records[address] = [index, reserved, sequence]
+        self.writes += 1
+
+    #---------------------RollingCodeStore::has---------------------------------
+    def has(self, shutterId):
+        return int(shutterId, 16) in self.codes
+
+    #---------------------RollingCodeStore::get---------------------------------
+    def get(self, shutterId):
+        return self.codes.get(int(shutterId, 16))
+
+    #---------------------RollingCodeStore::setCodes----------------------------
+    # Set the next code to send for several shutters. The file is only written
+    # for shutters that used up their reserved block.
+    def setCodes(self, codes, exact = False):
+        with self.lock:
+            written = False
+            for shutterId, code in codes.items():
+                address = int(shutterId, 16)
+                self.codes[address] = code
+                if exact:
+                    self.writeRecord(address, code)
+                    written = True
+                elif (address not in self.records) or (code > self.records[address][1]):
+                    self.writeRecord(address, code + self.Reserve - 1)
+                    written = True
+            if written:
+                os.fsync(self.fd)
+
+    #---------------------RollingCodeStore::close-------------------------------
+    # Store the exact codes, nothing needs to be skipped after a clean shutdown
+    def close(self):
+        with self.lock:
+            if self.fd == None:
+                return
+            written = False
+            for address, code in self.codes.items():
+                if self.records[address][1] != code:
+                    self.writeRecord(address, code)
+                    written = True
+            if written:
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    #---------------------RollingCodeStore::getStatistics-----------------------
+    def getStatistics(self):
+        return {'shutters': len(self.codes), 'writes': self.writes, 'reserve': self.Reserve}
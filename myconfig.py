@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 
+import os
 import threading
+import collections
 try:
     from ConfigParser import RawConfigParser
 except ImportError as e:
     from configparser import RawConfigParser
 
 from mylog import MyLog
+from mycodestore import RollingCodeStore
+from mytravelcurve import TravelCurve
 
 class MyConfig (MyLog):
     #---------------------MyConfig::__init__------------------------------------
@@ -32,6 +36,17 @@ class MyConfig (MyLog):
         self.ShuttersByName = {}
         self.Schedule = {}
         self.Password = ""
+        self.RollingCodeFile = None
+        self.PositionFile = None
+        self.MotionHistoryFile = None
+        self.MotionHistorySize = 256
+        self.AstroFile = None
+        self.TraceFrames = False
+        self.Transmitter = "pigpio"
+        self.TXGPIO = None
+        self.Radios = collections.OrderedDict()
+        self.RollingCodeReserve = 16
+        self.CodeStore = None
 
         try:
             self.config = RawConfigParser()
@@ -50,7 +65,7 @@ class MyConfig (MyLog):
     # -------------------- MyConfig::LoadConfig-----------------------------------
     def LoadConfig(self):
 
-        parameters = {'LogLocation': str, 'Latitude': float, 'Longitude': float, 'SendRepeat': int, 'UseHttps': bool, 'HTTPPort': int, 'HTTPSPort': int, 'TXGPIO': int, 'RTS_Address': str, "Password": str}
+        parameters = {'LogLocation': str, 'Latitude': float, 'Longitude': float, 'SendRepeat': int, 'UseHttps': bool, 'HTTPPort': int, 'HTTPSPort': int, 'TXGPIO': int, 'RTS_Address': str, "Password": str, 'RollingCodeFile': str, 'RollingCodeReserve': int, 'PositionFile': str, 'MotionHistoryFile': str, 'MotionHistorySize': int, 'AstroFile': str, 'TraceFrames': bool, 'Transmitter': str}
         
         self.SetSection("General");
         for key, type in parameters.items():
@@ -72,6 +87,9 @@ class MyConfig (MyLog):
                 self.LogErrorLine("Missing config file or config file entries in Section General for key "+key+": " + str(e1))
                 return False
 
+        if not self.LoadRadios():
+            return False
+
         self.SetSection("Shutters");
         shutters = self.GetList();
         for key, value in shutters:
@@ -80,21 +98,35 @@ class MyConfig (MyLog):
                 if param1[1].strip().lower() == 'true':
                    if (len(param1) < 3):
                        param1.append("10");
-                   elif (param1[2].strip() == "") or (int(param1[2]) <= 0) or (int(param1[2]) >= 100):
-                       param1[2] = "10"
                    param2 = int(self.ReadValue(key, section="ShutterRollingCodes",          return_type=int))
                    param3 =     self.ReadValue(key, section="ShutterIntermediatePositions", return_type=int)
                    if (param3 != None) and ((param3 < 0) or (param3 > 100)):
                        param3  = None
+                   durationDown = self.ParseDuration(param1[2])
                    # If only one duration is specified, use it for both down and up durations.
-                   if len (param1) < 4:
-                      param1.append(param1[2])
-                   self.Shutters[key] = {'name': param1[0], 'code': param2, 'durationDown': int(param1[2]), 'durationUp': int(param1[3]), 'intermediatePosition': param3}
+                   durationUp = self.ParseDuration(param1[3], durationDown) if len(param1) > 3 else durationDown
+                   radio = self.ReadValue(key, section="ShutterRadios", NoLog=True)
+                   if radio != None:
+                       radio = radio.strip().lower()   # like the keys of [Radios]
+                   if (radio != None) and (radio not in self.Radios):
+                       self.LogError("Radio " + radio + " of shutter " + key + " is not in section Radios, using radio " + next(iter(self.Radios)))
+                       radio = None
+                   self.Shutters[key] = {'name': param1[0], 'code': param2, 'durationDown': durationDown, 'durationUp': durationUp, 'intermediatePosition': param3, 'radio': radio}
+                   self.Shutters[key].update(self.LoadTravelCurves(key))
                    self.ShuttersByName[param1[0]] = key
             except Exception as e1:
                 self.LogErrorLine("Missing config file or config file entries in Section Shutters for key "+key+": " + str(e1))
                 return False
-                                   
+
+        if not self.LoadCodes():
+            return False
+        if self.PositionFile == None:
+            self.PositionFile = os.path.splitext(self.FileName)[0] + ".positions"
+        if self.MotionHistoryFile == None:
+            self.MotionHistoryFile = os.path.splitext(self.FileName)[0] + ".history"
+        if self.AstroFile == None:
+            self.AstroFile = os.path.splitext(self.FileName)[0] + ".astro"
+
         self.SetSection("Scheduler")
         schedules = self.GetList()
         for key, value in schedules:
@@ -108,6 +140,90 @@ class MyConfig (MyLog):
                                    
         return True
 
+    #---------------------MyConfig::LoadRadios----------------------------------
+    # Each entry of [Radios] is a name followed by the TX GPIO and optionally
+    # the SPI bus and chip select of its CC1101. Without the section there is a
+    # single radio on TXGPIO.
+    def LoadRadios(self):
+        if "Radios" in self.GetSections():
+            self.SetSection("Radios")
+            for key, value in self.GetList():
+                try:
+                    param = [int(p) for p in value.split(",")]
+                    param += [0] * (3 - len(param))
+                    self.Radios[key] = {'gpio': param[0], 'spiBus': param[1], 'spiChipSelect': param[2]}
+                except Exception as e1:
+                    self.LogErrorLine("Invalid config file entry in Section Radios for key "+key+": " + str(e1))
+                    return False
+        if len(self.Radios) == 0:
+            self.Radios["default"] = {'gpio': self.TXGPIO if self.TXGPIO != None else 24, 'spiBus': 0, 'spiChipSelect': 0}
+        return True
+
+    #---------------------MyConfig::ParseDuration-------------------------------
+    # Seconds of a full travel from [Shutters], default if missing or out of
+    # range (0 < duration < 100)
+    def ParseDuration(self, value, default = 10):
+        value = str(value).strip()
+        if value == "":
+            return default
+        duration = int(float(value))
+        if (duration <= 0) or (duration >= 100):
+            return 10
+        return duration
+
+    #---------------------MyConfig::LoadTravelCurves----------------------------
+    # Calibrated travel of a shutter from [ShutterCalibrationDown] and
+    # [ShutterCalibrationUp]. Without calibration the shutter is assumed to
+    # move at constant speed for its duration, with calibration the duration
+    # is the one of the curve.
+    def LoadTravelCurves(self, shutterId):
+        curves = {}
+        for direction, section in (('down', "ShutterCalibrationDown"), ('up', "ShutterCalibrationUp")):
+            key = 'duration' + direction.capitalize()
+            value = self.ReadValue(shutterId, section=section, NoLog=True)
+            curve = None
+            if value != None:
+                try:
+                    curve = TravelCurve.parse(direction, value)
+                    curves[key] = curve.duration
+                except Exception as e1:
+                    self.LogError("Invalid calibration of shutter " + shutterId + " in section " + section + ", assuming constant speed: " + str(e1))
+            if curve == None:
+                curve = TravelCurve.linear(direction, self.Shutters[shutterId][key])
+            curves['curve' + direction.capitalize()] = curve
+        return curves
+
+    #---------------------MyConfig::LoadCodes-----------------------------------
+    # Rolling codes live in their own file, see RollingCodeStore. Codes of
+    # shutters not yet in that file are taken over from [ShutterRollingCodes].
+    # That value is stale once the file is used: if the file has corrupt
+    # records, a shutter may have lost its record and its code is moved on by
+    # RecoverySkip so it does not go backwards.
+    def LoadCodes(self):
+        try:
+            if self.RollingCodeFile == None:
+                self.RollingCodeFile = os.path.splitext(self.FileName)[0] + ".codes"
+            self.CodeStore = RollingCodeStore(self.RollingCodeFile, reserve = self.RollingCodeReserve, log = self.log)
+            self.CodeStore.open()
+
+            migrate = {}
+            for shutterId in self.Shutters:
+                if self.CodeStore.has(shutterId):
+                    self.Shutters[shutterId]['code'] = self.CodeStore.get(shutterId)
+                elif self.CodeStore.corruptRecords > 0:
+                    migrate[shutterId] = int(self.Shutters[shutterId]['code']) + RollingCodeStore.RecoverySkip
+                    self.LogError("Rolling code of shutter " + shutterId + " may have been in a corrupt record of " + self.RollingCodeFile + ", skipping ahead to " + str(migrate[shutterId]))
+                    self.Shutters[shutterId]['code'] = migrate[shutterId]
+                else:
+                    migrate[shutterId] = self.Shutters[shutterId]['code']
+            if len(migrate) > 0:
+                self.LogInfo("Moving rolling codes to " + self.RollingCodeFile + ": " + str(migrate))
+                self.CodeStore.setCodes(migrate, exact = True)
+        except Exception as e1:
+            self.LogErrorLine("Error loading rolling codes from " + str(self.RollingCodeFile) + ": " + str(e1))
+            return False
+        return True
+
     #---------------------MyConfig::setLocation---------------------------------
     def setLocation(self, lat, lng):
         self.WriteValue("Latitude", lat, section="General");
@@ -117,8 +233,24 @@ class MyConfig (MyLog):
 
     #---------------------MyConfig::setCode---------------------------------
     def setCode(self, shutterId, code):
-        self.WriteValue(shutterId, str(code), section="ShutterRollingCodes");
-        self.Shutters[shutterId]['code'] = code
+        self.setCodes({shutterId: code})
+
+    #---------------------MyConfig::setCodes--------------------------------
+    # Store the rolling codes of several shutters in one write
+    def setCodes(self, codes):
+        self.CodeStore.setCodes(codes)
+        for shutterId, code in codes.items():
+            self.Shutters[shutterId]['code'] = code
+
+    #---------------------MyConfig::resetCode-------------------------------
+    # Start over with the given code, e.g. for a newly added shutter
+    def resetCode(self, shutterId, code):
+        self.CodeStore.setCodes({shutterId: code}, exact = True)
+
+    #---------------------MyConfig::Close-----------------------------------
+    def Close(self):
+        if self.CodeStore != None:
+            self.CodeStore.close()
         
 
     #---------------------MyConfig::HasOption-----------------------------------
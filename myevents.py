@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, time
+import threading
+import collections
+import traceback
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+#------------ Subscriber class ------------------------------------------------
+# Dispatcher thread of one subscriber. Holds the latest position of each
+# shutter not delivered yet, oldest first, and calls the subscriber with them.
+class Subscriber(threading.Thread, MyLog):
+
+    #---------------------Subscriber::__init__----------------------------------
+    def __init__(self, name, function, maxPending, log = None):
+        threading.Thread.__init__(self, name = "PositionEvents " + name)
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        if log != None:
+            self.log = log
+        self.subscriberName = name
+        self.function = function
+        self.maxPending = maxPending
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+
+    #---------------------Subscriber::put---------------------------------------
+    def put(self, shutterId, position):
+        with self.condition:
+            if shutterId in self.pending:
+                # keeps its place in the queue, only the value is updated
+                self.coalesced += 1
+            elif len(self.pending) >= self.maxPending:
+                self.pending.popitem(last = False)
+                self.dropped += 1
+            self.pending[shutterId] = position
+            self.condition.notify()
+
+    #---------------------Subscriber::stop--------------------------------------
+    # What is pending is still delivered
+    def stop(self):
+        self.shutdown_flag.set()
+        with self.condition:
+            self.condition.notify()
+
+    #---------------------Subscriber::run---------------------------------------
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.shutdown_flag.is_set():
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    break
+                shutterId, position = self.pending.popitem(last = False)
+
+            try:
+                self.function(shutterId, position)
+                self.delivered += 1
+            except Exception as e1:
+                self.errors += 1
+                self.LogError("Error delivering position of " + shutterId + " to " + self.subscriberName + ": " + str(e1))
+                self.LogDebug(traceback.format_exc())
+        return
+
+    #---------------------Subscriber::getStatistics-----------------------------
+    def getStatistics(self):
+        with self.condition:
+            return {'pending': len(self.pending), 'delivered': self.delivered, 'coalesced': self.coalesced, 'dropped': self.dropped, 'errors': self.errors}
+
+#------------ PositionEventBus class ------------------------------------------
+# Position changes are published without waiting for the subscribers (MQTT,
+# ...), each subscriber gets them from its own dispatcher thread, so a slow
+# one holds back neither the publisher nor the other subscribers. Updates of a
+# shutter not delivered yet are coalesced to the latest one: a slow subscriber
+# only gets fewer intermediate positions, never a stale one. Each subscriber
+# holds at most maxPending shutters, beyond that the oldest update is dropped.
+class PositionEventBus(MyLog):
+
+    #---------------------PositionEventBus::__init__----------------------------
+    def __init__(self, log = None):
+        super(PositionEventBus, self).__init__()
+        if log != None:
+            self.log = log
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.published = 0
+
+    #---------------------PositionEventBus::subscribe---------------------------
+    # function(shutterId, position) is called from the subscriber's thread
+    def subscribe(self, function, name = None, maxPending = 256):
+        if name == None:
+            name = getattr(function, '__qualname__', str(function))
+        subscriber = Subscriber(name, function, maxPending, log = self.log)
+        subscriber.setDaemon(True)
+        subscriber.start()
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+        return subscriber
+
+    #---------------------PositionEventBus::publish-----------------------------
+    def publish(self, shutterId, position):
+        with self.lock:
+            self.published += 1
+            subscribers = self.subscribers
+        for subscriber in subscribers:
+            subscriber.put(shutterId, position)
+
+    #---------------------PositionEventBus::close-------------------------------
+    # Delivers what is pending, waiting at most timeout seconds
+    def close(self, timeout = 5):
+        with self.lock:
+            subscribers = self.subscribers
+        for subscriber in subscribers:
+            subscriber.stop()
+        deadline = time.monotonic() + timeout
+        for subscriber in subscribers:
+            subscriber.join(max(0, deadline - time.monotonic()))
+
+    #---------------------PositionEventBus::getStatistics-----------------------
+    def getStatistics(self):
+        with self.lock:
+            subscribers = self.subscribers
+            published = self.published
+        return {'published': published, 'subscribers': {subscriber.subscriberName: subscriber.getStatistics() for subscriber in subscribers}}
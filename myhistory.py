@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, os, time, struct, math
+import threading
+from array import array
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+#------------ MotionRing class -------------------------------------------------
+# Last motions of one shutter, one preallocated array per field, written round
+# robin: the memory used does not grow however long the daemon runs. The
+# totals count every motion since the history was started.
+class MotionRing(object):
+    Fields = (('times', 'd'), ('sources', 'B'), ('directions', 'B'), ('starts', 'f'), ('targets', 'f'), ('ends', 'f'), ('waits', 'f'), ('runTimes', 'f'))
+
+    #---------------------MotionRing::__init__----------------------------------
+    def __init__(self, size):
+        self.size = size
+        for name, typecode in self.Fields:
+            setattr(self, name, array(typecode, [0]) * size)
+        self.next = 0
+        self.count = 0
+        self.totalMoves = 0
+        self.totalRunTime = 0.0
+        self.totalWait = 0.0
+        self.waitedMoves = 0
+
+    #---------------------MotionRing::append------------------------------------
+    def append(self, timestamp, source, direction, start, target, end, wait, runTime):
+        index = self.next
+        self.times[index] = timestamp
+        self.sources[index] = source
+        self.directions[index] = direction
+        self.starts[index] = start
+        self.targets[index] = target
+        self.ends[index] = end
+        self.waits[index] = wait
+        self.runTimes[index] = runTime
+        self.next = (index + 1) % self.size
+        self.count = min(self.size, self.count + 1)
+        self.totalMoves += 1
+        self.totalRunTime += runTime
+        if not math.isnan(wait):
+            self.totalWait += wait
+            self.waitedMoves += 1
+
+    #---------------------MotionRing::indexes-----------------------------------
+    # Indexes of the motions held, oldest first
+    def indexes(self):
+        return [(self.next - self.count + i) % self.size for i in range(self.count)]
+
+#------------ MotionHistory class ----------------------------------------------
+# Motions of every shutter: when they started, who asked for them, their
+# direction, start, target and end position, how long the command waited before it
+# was on the air and how long the motor ran. A motion is recorded when it
+# ends, by reaching its target, a stop or another command.
+#
+# The history is saved to a file (magic, then per shutter a header and the
+# arrays), so it survives restarts and can be dumped from the command line.
+# It is written from its own thread at most every SaveInterval seconds, the
+# threads moving the shutters never wait for the SD card.
+class MotionHistory(threading.Thread, MyLog):
+    Magic = b'RTSHIST2'
+    SaveInterval = 300      # seconds
+    HeaderFormat = '>IIIIIddI'   # address, size, next, count, totalMoves, totalRunTime, totalWait, waitedMoves
+    Sources = ('unknown', 'cli', 'web', 'mqtt', 'alexa', 'scheduler')
+    Directions = (None, 'up', 'down')
+
+    #---------------------MotionHistory::__init__-------------------------------
+    def __init__(self, filename = None, size = 256, log = None):
+        threading.Thread.__init__(self, name = "MotionHistory")
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        if log != None:
+            self.log = log
+        self.FileName = filename
+        self.size = max(1, int(size))
+        self.lock = threading.Lock()
+        self.rings = {}     # shutterId -> MotionRing
+        self.dirty = False
+
+    #---------------------MotionHistory::record---------------------------------
+    # timestamp is time.time() at the start of the motion, wait None if unknown
+    def record(self, shutterId, timestamp, source, direction, start, target, end, wait, runTime):
+        source = self.Sources.index(source) if source in self.Sources else 0
+        with self.lock:
+            if shutterId not in self.rings:
+                self.rings[shutterId] = MotionRing(self.size)
+            self.rings[shutterId].append(timestamp, source, self.Directions.index(direction), start, target, end, wait if wait != None else float('nan'), max(0, runTime))
+            self.dirty = True
+
+    #---------------------MotionHistory::getHistory-----------------------------
+    # Motions of a shutter (or all of them), oldest first
+    def getHistory(self, shutterId = None):
+        with self.lock:
+            history = {}
+            for id, ring in self.rings.items():
+                if (shutterId != None) and (id != shutterId):
+                    continue
+                history[id] = [{'time': time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(ring.times[i])),
+                                'source': self.Sources[ring.sources[i]],
+                                'direction': self.Directions[ring.directions[i]],
+                                'start': round(ring.starts[i], 1),
+                                'target': round(ring.targets[i], 1),
+                                'end': round(ring.ends[i], 1),
+                                'wait': None if math.isnan(ring.waits[i]) else round(ring.waits[i], 3),
+                                'runTime': round(ring.runTimes[i], 2)} for i in ring.indexes()]
+            return history
+
+    #---------------------MotionHistory::getStatistics--------------------------
+    # Totals since the history was started, moves per day and sources over
+    # the motions still held
+    def getStatistics(self, shutterId = None):
+        with self.lock:
+            stats = {}
+            for id, ring in self.rings.items():
+                if (shutterId != None) and (id != shutterId):
+                    continue
+                indexes = ring.indexes()
+                days = max(1.0, (ring.times[indexes[-1]] - ring.times[indexes[0]]) / 86400) if len(indexes) else 1.0
+                sources = {}
+                for i in indexes:
+                    sources[self.Sources[ring.sources[i]]] = sources.get(self.Sources[ring.sources[i]], 0) + 1
+                stats[id] = {'moves': ring.totalMoves, 'runTime': round(ring.totalRunTime, 1),
+                             'averageWait': round(ring.totalWait / ring.waitedMoves, 3) if ring.waitedMoves else None,
+                             'recorded': ring.count, 'movesPerDay': round(ring.count / days, 1), 'sources': sources}
+            return stats
+
+    #---------------------MotionHistory::load-----------------------------------
+    # The motions are matched to shutterIds on their address, whatever the
+    # spelling of the id; other shutters keep the id 0x<address>
+    def load(self, shutterIds = ()):
+        if (self.FileName == None) or not os.path.isfile(self.FileName):
+            return
+        with open(self.FileName, "rb") as f:
+            data = f.read()
+        if data[:len(self.Magic)] != self.Magic:
+            self.LogWarn("Not a motion history file, ignoring it: " + self.FileName)
+            return
+        shutterIds = {int(shutterId, 16): shutterId for shutterId in shutterIds}
+        rings = {}
+        offset = len(self.Magic)
+        headerSize = struct.calcsize(self.HeaderFormat)
+        try:
+            while offset < len(data):
+                address, size, next, count, totalMoves, totalRunTime, totalWait, waitedMoves = struct.unpack_from(self.HeaderFormat, data, offset)
+                offset += headerSize
+                stored = MotionRing(size)
+                for name, typecode in MotionRing.Fields:
+                    column = getattr(stored, name)
+                    length = size * column.itemsize
+                    setattr(stored, name, array(typecode, data[offset:offset + length]))
+                    offset += length
+                stored.next, stored.count = next, count
+                # replayed, the size may have changed since the file was written
+                ring = MotionRing(self.size)
+                for i in stored.indexes():
+                    ring.append(*(getattr(stored, name)[i] for name, typecode in MotionRing.Fields))
+                ring.totalMoves, ring.totalRunTime, ring.totalWait, ring.waitedMoves = totalMoves, totalRunTime, totalWait, waitedMoves
+                rings[shutterIds.get(address, "0x%06x" % address)] = ring
+        except Exception as e1:
+            self.LogError("Corrupt motion history file " + self.FileName + ", ignoring the rest: " + str(e1))
+        with self.lock:
+            self.rings.update(rings)
+
+    #---------------------MotionHistory::run------------------------------------
+    def run(self):
+        while not self.shutdown_flag.wait(self.SaveInterval):
+            self.trySave()
+        return
+
+    #---------------------MotionHistory::trySave--------------------------------
+    def trySave(self):
+        try:
+            self.save()
+        except Exception as e1:
+            self.LogError("Error writing motion history to " + str(self.FileName) + ": " + str(e1))
+
+    #---------------------MotionHistory::close----------------------------------
+    def close(self):
+        self.shutdown_flag.set()
+        if self.is_alive():
+            self.join()
+        self.trySave()
+
+    #---------------------MotionHistory::save-----------------------------------
+    def save(self):
+        if self.FileName == None:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = [self.Magic]
+            for shutterId, ring in self.rings.items():
+                data.append(struct.pack(self.HeaderFormat, int(shutterId, 16), ring.size, ring.next, ring.count, ring.totalMoves, ring.totalRunTime, ring.totalWait, ring.waitedMoves))
+                data += [getattr(ring, name).tobytes() for name, typecode in MotionRing.Fields]
+            self.dirty = False
+        temporary = self.FileName + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.FileName)
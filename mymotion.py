@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, time
+import threading
+import heapq
+import itertools
+import traceback
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+#------------ MotionTracker class ---------------------------------------------
+# Single thread running the deadlines of all moving shutters ("motor has
+# reached the end position", ...) from a heap, instead of one sleeping thread
+# per movement. There is at most one pending deadline per key (the shutter
+# id): scheduling a new one replaces it, so a new command supersedes what the
+# previous one expected.
+class MotionTracker(threading.Thread, MyLog):
+
+    #---------------------MotionTracker::__init__-------------------------------
+    def __init__(self, log = None, name = "MotionTracker"):
+        threading.Thread.__init__(self, name=name)
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        if log != None:
+            self.log = log
+        self.condition = threading.Condition()
+        self.heap = []          # [deadline, sequence, key, function, args, onCancel], cancelled ones have key None
+        self.pending = {}       # key -> heap entry
+        self.sequence = itertools.count()
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.maxPending = 0
+
+    #---------------------MotionTracker::schedule-------------------------------
+    # Calls function(*args) in delay seconds, replacing what was pending for
+    # key. onCancel() is called instead if it is replaced or cancelled.
+    def schedule(self, key, delay, function, *args, onCancel = None):
+        with self.condition:
+            self.cancelLocked(key)
+            entry = [time.monotonic() + max(0, delay), next(self.sequence), key, function, args, onCancel]
+            self.pending[key] = entry
+            heapq.heappush(self.heap, entry)
+            self.scheduled += 1
+            self.maxPending = max(self.maxPending, len(self.pending))
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    #---------------------MotionTracker::cancel---------------------------------
+    # Returns True if something was pending for key
+    def cancel(self, key):
+        with self.condition:
+            return self.cancelLocked(key)
+
+    #---------------------MotionTracker::cancelLocked---------------------------
+    def cancelLocked(self, key):
+        entry = self.pending.pop(key, None)
+        if entry == None:
+            return False
+        # left in the heap and skipped when due, removing it would be O(n)
+        entry[2] = None
+        self.cancelled += 1
+        if entry[5] != None:
+            try:
+                entry[5]()
+            except Exception as e1:
+                self.LogError("Motion tracker: error cancelling: " + str(e1))
+        return True
+
+    #---------------------MotionTracker::getDeadline----------------------------
+    # Seconds left before the deadline pending for key, None if there is none
+    def getDeadline(self, key):
+        with self.condition:
+            entry = self.pending.get(key)
+            return None if entry == None else max(0, entry[0] - time.monotonic())
+
+    #---------------------MotionTracker::stop-----------------------------------
+    # What is still pending is cancelled
+    def stop(self):
+        self.shutdown_flag.set()
+        with self.condition:
+            for key in list(self.pending):
+                self.cancelLocked(key)
+            self.condition.notify()
+
+    #---------------------MotionTracker::run------------------------------------
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            with self.condition:
+                while len(self.heap) and self.heap[0][2] == None:
+                    heapq.heappop(self.heap)
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                timeout = self.heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                deadline, sequence, key, function, args, onCancel = heapq.heappop(self.heap)
+                del self.pending[key]
+                self.fired += 1
+
+            # outside of the lock, the function may schedule again
+            try:
+                function(*args)
+            except Exception as e1:
+                self.LogError("Motion tracker: error for " + str(key) + ": " + str(e1))
+                self.LogError(traceback.format_exc())
+        return
+
+    #---------------------MotionTracker::getStatistics--------------------------
+    def getStatistics(self):
+        with self.condition:
+            return {'pending': len(self.pending), 'maxPending': self.maxPending, 'scheduled': self.scheduled, 'fired': self.fired, 'cancelled': self.cancelled}
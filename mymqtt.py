@@ -8,7 +8,6 @@ import os
 import re
 import time
 import locale
-import pigpio
 import socket
 import signal, atexit, subprocess, traceback
 import threading
@@ -86,17 +85,17 @@ class MQTT(threading.Thread, MyLog):
             if (command == "cmd"):
                 self.LogInfo("sending message: "+str(msg))
                 if msg == "STOP":
-                    self.shutter.stop(shutterId)
+                    self.shutter.stop(shutterId, source = 'mqtt')
                 elif int(msg) == 0:
-                    self.shutter.lower(shutterId)
+                    self.shutter.lower(shutterId, source = 'mqtt')
                 elif int(msg) == 100:
-                    self.shutter.rise(shutterId)
+                    self.shutter.rise(shutterId, source = 'mqtt')
                 elif (int(msg) > 0) and (int(msg) < 100):
                     currentPosition = self.shutter.getPosition(shutterId)
                     if int(msg) > currentPosition:
-                        self.shutter.risePartial(shutterId, int(msg))
+                        self.shutter.risePartial(shutterId, int(msg), source = 'mqtt')
                     elif int(msg) < currentPosition:   
-                        self.shutter.lowerPartial(shutterId, int(msg))
+                        self.shutter.lowerPartial(shutterId, int(msg), source = 'mqtt')
             else:
                 self.LogError("received unkown message: "+topic+", message: "+msg)
     
@@ -139,7 +138,7 @@ class MQTT(threading.Thread, MyLog):
             
     def set_state(self, shutterId, level):
         self.LogInfo("Received request to set Shutter "+shutterId+" to "+str(level))
-        self.sendMQTT("somfy/"+shutterId+"/level/set_state", str(level))
+        self.sendMQTT("somfy/"+shutterId+"/level/set_state", str(int(round(level))))
             
     def run(self):
         self.connected_flag = False
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, os, struct, zlib
+import threading
+import collections
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+# Last known state of a shutter. direction is 'up', 'down' or None; when
+# moving, position is the start position of the motion started at
+# commandTime (time.time()) and partial tells the daemon had to send the stop.
+PositionRecord = collections.namedtuple('PositionRecord', ['position', 'direction', 'partial', 'target', 'duration', 'commandTime'])
+
+#------------ PositionStore class ---------------------------------------------
+# Shutter positions are kept in a snapshot file holding one record per shutter
+# and a journal the changes are appended to. Changes are collected in memory
+# and only the latest one per shutter is written, every FlushInterval seconds,
+# so the SD card is not written on every position update. The journal is
+# merged into a new snapshot once it holds CompactRecords records.
+#
+# Every record carries its crc32, a record torn by a power loss at the end of
+# the journal is ignored.
+class PositionStore(threading.Thread, MyLog):
+    Magic = b'RTSPOS01'
+    RecordFormat = '>IBfffd'
+    RecordSize = struct.calcsize(RecordFormat) + 4
+    FlushInterval = 10      # seconds
+    CompactRecords = 1000
+    Directions = {None: 0, 'up': 1, 'down': 2}
+    PartialFlag = 0x80
+
+    #---------------------PositionStore::__init__-------------------------------
+    def __init__(self, filename, log = None):
+        threading.Thread.__init__(self, name = "PositionStore")
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        if log != None:
+            self.log = log
+        self.FileName = filename
+        self.JournalName = filename + ".journal"
+        self.lock = threading.Lock()
+        self.records = {}       # address -> PositionRecord, as written
+        self.pending = {}       # address -> PositionRecord, not written yet
+        self.journalFd = None
+        self.journalRecords = 0
+        self.updates = 0
+        self.writes = 0
+        self.flushes = 0
+        self.compactions = 0
+
+    #---------------------PositionStore::pack-----------------------------------
+    def pack(self, address, record):
+        flags = self.Directions[record.direction] | (self.PartialFlag if record.partial else 0)
+        data = struct.pack(self.RecordFormat, address, flags, record.position, record.target if record.target != None else 0, record.duration if record.duration != None else 0, record.commandTime)
+        return data + struct.pack('>I', zlib.crc32(data))
+
+    #---------------------PositionStore::unpack---------------------------------
+    # Returns (address, record), None if the record is corrupt
+    def unpack(self, data, offset):
+        body = data[offset:offset + self.RecordSize - 4]
+        if struct.unpack_from('>I', data, offset + self.RecordSize - 4)[0] != zlib.crc32(body):
+            return None
+        address, flags, position, target, duration, commandTime = struct.unpack(self.RecordFormat, body)
+        direction = {v: k for k, v in self.Directions.items()}.get(flags & 0x3)
+        return address, PositionRecord(position, direction, bool(flags & self.PartialFlag), target if direction != None else None, duration if direction != None else None, commandTime)
+
+    #---------------------PositionStore::readRecords----------------------------
+    def readRecords(self, filename):
+        if not os.path.isfile(filename):
+            return 0
+        with open(filename, "rb") as f:
+            data = f.read()
+        if data[:len(self.Magic)] != self.Magic:
+            self.LogWarn("Not a position file, ignoring it: " + filename)
+            return 0
+        count = 0
+        for offset in range(len(self.Magic), len(data) - self.RecordSize + 1, self.RecordSize):
+            entry = self.unpack(data, offset)
+            if entry == None:
+                self.LogWarn("Corrupt position record in " + filename + " at offset " + str(offset) + ", ignoring the rest")
+                break
+            self.records[entry[0]] = entry[1]
+            count += 1
+        return count
+
+    #---------------------PositionStore::load-----------------------------------
+    # Reads the snapshot and replays the journal. Returns {shutterId: PositionRecord}
+    # of the given shutters, matched on their address like the rolling codes
+    def load(self, shutterIds):
+        with self.lock:
+            self.records = {}
+            self.readRecords(self.FileName)
+            self.journalRecords = self.readRecords(self.JournalName)
+            # start over with a clean snapshot and an empty journal
+            self.compact()
+            return {shutterId: self.records[int(shutterId, 16)] for shutterId in shutterIds if int(shutterId, 16) in self.records}
+
+    #---------------------PositionStore::update---------------------------------
+    # Queues the state of a shutter, it is written with the next flush
+    def update(self, shutterId, record):
+        with self.lock:
+            self.pending[int(shutterId, 16)] = record
+            self.updates += 1
+
+    #---------------------PositionStore::run------------------------------------
+    def run(self):
+        while not self.shutdown_flag.wait(self.FlushInterval):
+            try:
+                self.flush()
+            except Exception as e1:
+                self.LogError("Error writing positions to " + self.JournalName + ": " + str(e1))
+        return
+
+    #---------------------PositionStore::flush----------------------------------
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            pending = self.pending
+            self.pending = {}
+            os.write(self.journalFd, b''.join(self.pack(address, record) for address, record in pending.items()))
+            os.fsync(self.journalFd)
+            self.records.update(pending)
+            self.journalRecords += len(pending)
+            self.writes += len(pending)
+            self.flushes += 1
+            if self.journalRecords >= self.CompactRecords:
+                self.compact()
+
+    #---------------------PositionStore::compact--------------------------------
+    # Must be called with self.lock held. Writes all records to a new snapshot
+    # and empties the journal.
+    def compact(self):
+        temporary = self.FileName + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(self.Magic + b''.join(self.pack(address, record) for address, record in self.records.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.FileName)
+
+        if self.journalFd != None:
+            os.close(self.journalFd)
+        self.journalFd = os.open(self.JournalName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        os.write(self.journalFd, self.Magic)
+        os.fsync(self.journalFd)
+        self.syncDirectory()
+        self.journalRecords = 0
+        self.compactions += 1
+
+    #---------------------PositionStore::syncDirectory--------------------------
+    def syncDirectory(self):
+        try:
+            dirfd = os.open(os.path.dirname(os.path.abspath(self.FileName)), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            pass
+
+    #---------------------PositionStore::close----------------------------------
+    def close(self):
+        self.shutdown_flag.set()
+        if self.is_alive():
+            self.join()
+        if self.journalFd == None:
+            return
+        self.flush()
+        with self.lock:
+            os.close(self.journalFd)
+            self.journalFd = None
+
+    #---------------------PositionStore::getStatistics--------------------------
+    def getStatistics(self):
+        with self.lock:
+            return {'shutters': len(self.records), 'updates': self.updates, 'writes': self.writes, 'pending': len(self.pending),
+                    'flushes': self.flushes, 'journalRecords': self.journalRecords, 'compactions': self.compactions}
@@ -0,0 +1,1036 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys, time, argparse
+import threading
+import collections
+import itertools
+import contextlib
+import queue
+import functools
+from concurrent.futures import Future
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+# pigpio and cc1101 are only needed to talk to the radio, encoding works without them
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+try:
+    import cc1101
+except ImportError:
+    cc1101 = None
+
+# Somfy RTS timings, in microseconds
+WAKEUP_US = 9415          # wake up pulse
+SILENCE_US = 89565        # silence after wake up
+HW_SYNC_US = 2560         # hardware synchronization (high and low)
+SW_SYNC_HIGH_US = 4550    # software synchronization (high)
+SW_SYNC_LOW_US = 640      # software synchronization (low)
+SYMBOL_US = 640           # half of a manchester encoded bit
+INTERFRAME_GAP_US = 30415 # interframe gap
+
+# Same field names as pigpio.pulse, so lists of Pulse can be handed to
+# pi.wave_add_generic() unchanged.
+Pulse = collections.namedtuple('Pulse', ['gpio_on', 'gpio_off', 'delay'])
+
+# Maximum loop count of a pigpio wave chain (16 bit)
+MAX_CHAIN_LOOPS = 65535
+
+#------------ LoopedWave class ------------------------------------------------
+# A command as sent on air: the first frame once, then the repeat frame
+# repeated 'repeats' times. The repeats are played by a wave_chain loop, so
+# only two waves are built whatever the repetition. first and repeat are pulse
+# lists, or handles of waves uploaded to the transmitter.
+class LoopedWave(collections.namedtuple('LoopedWave', ['first', 'repeat', 'repeats'])):
+    __slots__ = ()
+
+    #---------------------LoopedWave::expand------------------------------------
+    # The unrolled pulse list, only for pulse lists (decoding, verification)
+    def expand(self):
+        return self.first + self.repeat * self.repeats
+
+#------------ WaveformTemplate class ------------------------------------------
+# The wake up pulse, the synchronization and the interframe gap of a RTS
+# transmission never change for a given TX GPIO. They are built once, only the
+# 56 payload bits are rendered per command.
+class WaveformTemplate(object):
+
+    #---------------------WaveformTemplate::__init__----------------------------
+    def __init__(self, gpio):
+        self.gpio = gpio
+        mask = 1 << gpio
+
+        hardwareSync = [Pulse(mask, 0, HW_SYNC_US), Pulse(0, mask, HW_SYNC_US)]
+        softwareSync = [Pulse(mask, 0, SW_SYNC_HIGH_US), Pulse(0, mask, SW_SYNC_LOW_US)]
+
+        self.preamble = [Pulse(mask, 0, WAKEUP_US), Pulse(0, mask, SILENCE_US)] + hardwareSync * 2 + softwareSync
+        self.repeatPreamble = hardwareSync * 7 + softwareSync
+        self.gap = [Pulse(0, mask, INTERFRAME_GAP_US)]
+        bitZero = (Pulse(mask, 0, SYMBOL_US), Pulse(0, mask, SYMBOL_US))
+        bitOne = (Pulse(0, mask, SYMBOL_US), Pulse(mask, 0, SYMBOL_US))
+
+        # manchester encoding of every possible byte value, MSB first
+        self.byteTable = []
+        for octet in range(256):
+            pulses = ()
+            for shift in range(7, -1, -1):
+                pulses += bitOne if (octet >> shift) & 1 else bitZero
+            self.byteTable.append(pulses)
+
+        # airtime in microseconds, the payload duration does not depend on the data
+        payloadMicros = 7 * 8 * 2 * SYMBOL_US
+        self.frameMicros = sum(p.delay for p in self.preamble + self.gap) + payloadMicros
+        self.repeatMicros = sum(p.delay for p in self.repeatPreamble + self.gap) + payloadMicros
+
+    #---------------------WaveformTemplate::duration----------------------------
+    # Airtime in microseconds of a frame sent once and repeated (repetition - 1) times
+    def duration(self, repetition):
+        return self.frameMicros + max(0, repetition - 1) * self.repeatMicros
+
+    #---------------------WaveformTemplate::renderPayload-----------------------
+    def renderPayload(self, frame):
+        return list(itertools.chain.from_iterable(map(self.byteTable.__getitem__, frame)))
+
+    #---------------------WaveformTemplate::render------------------------------
+    # Returns the complete pulse list for the (obfuscated) frame, sent once
+    # and then repeated (repetition - 1) times.
+    def render(self, frame, repetition):
+        return self.renderLoop(frame, repetition).expand()
+
+    #---------------------WaveformTemplate::renderLoop--------------------------
+    # Same as render, with the repeats left to the wave chain
+    def renderLoop(self, frame, repetition):
+        payload = self.renderPayload(frame)
+        return LoopedWave(self.preamble + payload + self.gap, self.repeatPreamble + payload + self.gap, max(0, repetition - 1))
+
+#------------ RTSEncoder class ------------------------------------------------
+# Builds Somfy RTS frames and turns them into pulse lists. Does not depend on
+# pigpio, so it can be used without the radio hardware.
+class RTSEncoder(object):
+
+    #---------------------RTSEncoder::__init__----------------------------------
+    def __init__(self, gpio):
+        self.template = getWaveformTemplate(gpio)
+
+    #---------------------RTSEncoder::buildFrame--------------------------------
+    # Returns the plain frame, the checksum is not set yet
+    @staticmethod
+    def buildFrame(button, code, address):
+        frame = bytearray(7)
+        frame[0] = 0xA7                     # Encryption key. Doesn't matter much
+        frame[1] = button << 4              # Which button did  you press? The 4 LSB will be the checksum
+        frame[2] = (code >> 8) & 0xFF       # Rolling code (big endian)
+        frame[3] = code & 0xFF              # Rolling code
+        frame[4] = (address >> 16) & 0xFF   # Remote address
+        frame[5] = (address >> 8) & 0xFF    # Remote address
+        frame[6] = address & 0xFF           # Remote address
+        return frame
+
+    #---------------------RTSEncoder::addChecksum-------------------------------
+    @staticmethod
+    def addChecksum(frame):
+        checksum = 0
+        for octet in frame:
+            checksum = checksum ^ octet ^ (octet >> 4)
+        frame[1] |= checksum & 0b1111 # We keep the last 4 bits only
+        return frame
+
+    #---------------------RTSEncoder::obfuscate---------------------------------
+    @staticmethod
+    def obfuscate(frame):
+        for i in range(1, 7):
+            frame[i] ^= frame[i-1]
+        return frame
+
+    #---------------------RTSEncoder::render------------------------------------
+    def render(self, frame, repetition):
+        return self.template.render(frame, repetition)
+
+    #---------------------RTSEncoder::renderLoop--------------------------------
+    def renderLoop(self, frame, repetition):
+        return self.template.renderLoop(frame, repetition)
+
+    #---------------------RTSEncoder::duration----------------------------------
+    def duration(self, repetition):
+        return self.template.duration(repetition)
+
+    #---------------------RTSEncoder::encode------------------------------------
+    # Complete pulse list for a button press of the given remote
+    def encode(self, button, code, address, repetition):
+        frame = self.obfuscate(self.addChecksum(self.buildFrame(button, code, address)))
+        return self.template.render(frame, repetition)
+
+#------------ RTSDecoder class ------------------------------------------------
+# Recovers the frames from a pulse list as produced by RTSEncoder (or recorded
+# by the simulated radio): synchronization, obfuscated and plain frame,
+# checksum, button, rolling code and remote address. Used to verify that the
+# encoder still produces what a Somfy receiver expects.
+DecodedFrame = collections.namedtuple('DecodedFrame', ['wakeup', 'hardwareSyncs', 'obfuscated', 'frame', 'checksumOk', 'key', 'button', 'code', 'address'])
+
+class RTSDecoder(object):
+    Tolerance = 0.25
+
+    #---------------------RTSDecoder::__init__----------------------------------
+    def __init__(self, gpio):
+        self.mask = 1 << gpio
+
+    #---------------------RTSDecoder::matches-----------------------------------
+    def matches(self, duration, expected):
+        return abs(duration - expected) <= expected * self.Tolerance
+
+    #---------------------RTSDecoder::segments----------------------------------
+    # Turns the pulses into a list of [level, duration], merging consecutive
+    # pulses of the same level
+    def segments(self, pulses):
+        segments = []
+        level = 0
+        for p in pulses:
+            if p.gpio_on & self.mask:
+                level = 1
+            elif p.gpio_off & self.mask:
+                level = 0
+            if len(segments) and segments[-1][0] == level:
+                segments[-1][1] += p.delay
+            else:
+                segments.append([level, p.delay])
+        return segments
+
+    #---------------------RTSDecoder::decode------------------------------------
+    def decode(self, pulses):
+        segments = self.segments(pulses)
+        frames = []
+        i = 0
+        while i < len(segments):
+            level, duration = segments[i]
+            if not (level == 1 and self.matches(duration, SW_SYNC_HIGH_US)):
+                i += 1
+                continue
+
+            # look back for the hardware synchronization and the wake up pulse
+            hardwareSyncs = 0
+            j = i - 1
+            while j >= 1 and self.matches(segments[j][1], HW_SYNC_US) and self.matches(segments[j-1][1], HW_SYNC_US) and segments[j-1][0] == 1:
+                hardwareSyncs += 1
+                j -= 2
+            wakeup = j >= 1 and segments[j-1][0] == 1 and self.matches(segments[j-1][1], WAKEUP_US) and self.matches(segments[j][1], SILENCE_US)
+
+            # split the following segments in half bits, the first one is the
+            # end of the software synchronization
+            halfBits = []
+            i += 1
+            while i < len(segments) and len(halfBits) < 113:
+                level, duration = segments[i]
+                units = int(round(duration / SYMBOL_US))
+                if units > 2:   # interframe gap, only the end of the last bit belongs to the frame
+                    units = min(units, 113 - len(halfBits))
+                halfBits.extend([level] * units)
+                i += 1
+            if len(halfBits) < 113 or halfBits[0] != 0:
+                raise ValueError("Truncated frame after software synchronization")
+            halfBits = halfBits[1:]
+
+            obfuscated = bytearray(7)
+            for bit in range(56):
+                first, second = halfBits[2*bit], halfBits[2*bit+1]
+                if first == second:
+                    raise ValueError("Invalid manchester symbol at bit " + str(bit))
+                obfuscated[bit // 8] |= second << (7 - bit % 8)
+
+            frame = bytearray(obfuscated)
+            for n in range(6, 0, -1):
+                frame[n] ^= obfuscated[n-1]
+            check = bytearray(frame)
+            check[1] &= 0xF0
+            checksum = 0
+            for octet in check:
+                checksum = checksum ^ octet ^ (octet >> 4)
+
+            frames.append(DecodedFrame(wakeup = wakeup,
+                                       hardwareSyncs = hardwareSyncs,
+                                       obfuscated = bytes(obfuscated),
+                                       frame = bytes(frame),
+                                       checksumOk = (checksum & 0xF) == (frame[1] & 0xF),
+                                       key = frame[0],
+                                       button = frame[1] >> 4,
+                                       code = (frame[2] << 8) | frame[3],
+                                       address = (frame[4] << 16) | (frame[5] << 8) | frame[6]))
+        return frames
+
+#---------- verifyRoundTrip ---------------------------------------------------
+# Encodes a command, decodes the pulses and checks every frame. Returns a
+# list of problems, empty if the frames are correct.
+def verifyRoundTrip(encoder, decoder, button, code, address, repetition):
+    errors = []
+    frames = decoder.decode(encoder.encode(button, code, address, repetition))
+    if len(frames) != repetition:
+        errors.append("expected " + str(repetition) + " frames, decoded " + str(len(frames)))
+    for n, f in enumerate(frames):
+        expected = (n == 0, 2 if n == 0 else 7, True, 0xA7, button, code, address)
+        actual = (f.wakeup, f.hardwareSyncs, f.checksumOk, f.key, f.button, f.code, f.address)
+        if actual != expected:
+            errors.append("frame " + str(n) + ": expected " + str(expected) + ", decoded " + str(actual))
+    if sum(p.delay for p in encoder.encode(button, code, address, repetition)) != encoder.duration(repetition):
+        errors.append("airtime does not match the encoded pulses")
+    frame = encoder.obfuscate(encoder.addChecksum(encoder.buildFrame(button, code, address)))
+    if encoder.renderLoop(frame, repetition).expand() != _renderUncached(frame, repetition, encoder.template.gpio):
+        errors.append("looped wave does not match the unrolled reference")
+    return errors
+
+_templates = {}
+_templatesLock = threading.Lock()
+
+#---------- getWaveformTemplate -----------------------------------------------
+def getWaveformTemplate(gpio):
+    with _templatesLock:
+        if gpio not in _templates:
+            _templates[gpio] = WaveformTemplate(gpio)
+        return _templates[gpio]
+
+#------------ PigpioSession class ---------------------------------------------
+# Long-lived connection to pigpiod, shared by all transmissions and by all
+# radios. The connection is checked before use and re-established if pigpiod
+# went away. pigpiod builds one waveform at a time and has a single wave
+# engine, waveLock serializes their use between the radios.
+class PigpioSession(MyLog):
+
+    #---------------------PigpioSession::__init__-------------------------------
+    def __init__(self, log = None, outputs = []):
+        super(PigpioSession, self).__init__()
+        if log != None:
+            self.log = log
+        self.outputs = list(outputs)
+        self.lock = threading.Lock()
+        self.waveLock = threading.Lock()
+        self.pi = None
+        self.connects = 0
+        self.reconnects = 0
+
+    #---------------------PigpioSession::isAlive--------------------------------
+    def isAlive(self):
+        if (self.pi == None) or (not self.pi.connected):
+            return False
+        try:
+            self.pi.get_current_tick()
+            return True
+        except Exception as e1:
+            self.LogWarn("pigpio connection lost: " + str(e1))
+            return False
+
+    #---------------------PigpioSession::get------------------------------------
+    # Returns a connected pigpio.pi instance, (re-)connecting if needed
+    def get(self):
+        with self.lock:
+            if self.isAlive():
+                return self.pi
+
+            if pigpio == None:
+                raise Exception("pigpio module is not installed")
+            if self.pi != None:
+                self.reconnects += 1
+                self.LogWarn("Reconnecting to pigpiod (reconnect n°" + str(self.reconnects) + ")")
+                self.disconnect()
+
+            pi = pigpio.pi() # connect to Pi
+            if not pi.connected:
+                raise Exception("pigpio connection could not be established")
+            for gpio in self.outputs:
+                pi.set_mode(gpio, pigpio.OUTPUT)
+            self.connects += 1
+            self.pi = pi
+            return self.pi
+
+    #---------------------PigpioSession::addOutput-----------------------------
+    def addOutput(self, gpio):
+        with self.lock:
+            if gpio in self.outputs:
+                return
+            self.outputs.append(gpio)
+            if self.pi != None and self.pi.connected:
+                self.pi.set_mode(gpio, pigpio.OUTPUT)
+
+    #---------------------PigpioSession::waitForWave---------------------------
+    # Waits for the wave being transmitted to complete. Sleeps for most of the
+    # expected airtime, then polls wave_tx_busy at a bounded rate instead of
+    # spinning on it.
+    def waitForWave(self, pi, durationMicros, pollInterval = 0.002, timeout = 2.0):
+        deadline = time.monotonic() + durationMicros / 1e6
+        time.sleep(max(0, durationMicros / 1e6 - pollInterval))
+        while pi.wave_tx_busy():
+            if time.monotonic() > deadline + timeout:
+                raise Exception("Wave transmission did not complete in time")
+            time.sleep(pollInterval)
+
+    #---------------------PigpioSession::disconnect-----------------------------
+    def disconnect(self):
+        try:
+            if self.pi != None:
+                self.pi.stop()
+        except Exception as e1:
+            self.LogDebug("Error closing pigpio connection: " + str(e1))
+        self.pi = None
+
+    #---------------------PigpioSession::close----------------------------------
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+    #---------------------PigpioSession::getStatistics--------------------------
+    def getStatistics(self):
+        return {'connected': (self.pi != None) and self.pi.connected, 'connects': self.connects, 'reconnects': self.reconnects}
+
+#------------ CC1101Radio class -----------------------------------------------
+# Keeps the CC1101 transceiver open and configured between transmissions. The
+# registers are only programmed once; they are read back and checked from time
+# to time or after a failed transmission, and re-programmed if needed. Between
+# two transmissions the transceiver stays idle.
+class CC1101Radio(MyLog):
+    FrequencyHertz = 433.42e6
+    PATable = [0x0, 0x34]
+    PATableRegister = 0x3E
+    VerifyInterval = 300 # seconds
+
+    #---------------------CC1101Radio::__init__---------------------------------
+    def __init__(self, log = None, spiBus = 0, spiChipSelect = 0):
+        super(CC1101Radio, self).__init__()
+        if log != None:
+            self.log = log
+        self.spiBus = spiBus
+        self.spiChipSelect = spiChipSelect
+        self.lock = threading.Lock()
+        self.transceiver = None
+        self.lastVerifyTime = None
+        self.verifyRequired = False
+        self.configurations = 0
+        self.verifications = 0
+        self.errors = 0
+
+    #---------------------CC1101Radio::open-------------------------------------
+    def open(self):
+        with self.lock:
+            self.ensureReady()
+
+    #---------------------CC1101Radio::configure--------------------------------
+    def configure(self):
+        self.transceiver.set_base_frequency_hertz(self.FrequencyHertz)
+        self.transceiver._write_burst(start_register=self.PATableRegister, values=self.PATable)
+        self.configurations += 1
+        self.lastVerifyTime = time.monotonic()
+        self.verifyRequired = False
+        self.LogDebug("CC1101 configured")
+
+    #---------------------CC1101Radio::verify-----------------------------------
+    def verify(self):
+        self.verifications += 1
+        frequency = self.transceiver.get_base_frequency_hertz()
+        patable = list(self.transceiver._read_burst(start_register=self.PATableRegister, length=len(self.PATable)))
+        # the frequency registers have a resolution of about 400 Hz
+        if (abs(frequency - self.FrequencyHertz) > 1000) or (patable != self.PATable):
+            self.LogWarn("CC1101 registers changed (frequency " + str(frequency) + ", PA table " + str(patable) + "), reconfiguring")
+            self.configure()
+        else:
+            self.lastVerifyTime = time.monotonic()
+            self.verifyRequired = False
+
+    #---------------------CC1101Radio::ensureReady------------------------------
+    def ensureReady(self):
+        if self.transceiver == None:
+            if cc1101 == None:
+                raise Exception("cc1101 module is not installed")
+            transceiver = cc1101.CC1101(spi_bus = self.spiBus, spi_chip_select = self.spiChipSelect)
+            transceiver.__enter__()
+            self.transceiver = transceiver
+            self.configure()
+        elif self.verifyRequired or (time.monotonic() - self.lastVerifyTime > self.VerifyInterval):
+            self.verify()
+
+    #---------------------CC1101Radio::transmission-----------------------------
+    # Puts the transceiver in asynchronous transmission mode for the duration
+    # of the with block, the caller sends the wave on the TX GPIO meanwhile.
+    @contextlib.contextmanager
+    def transmission(self):
+        with self.lock:
+            try:
+                self.ensureReady()
+                with self.transceiver.asynchronous_transmission():
+                    yield
+            except Exception:
+                self.errors += 1
+                self.verifyRequired = True
+                raise
+
+    #---------------------CC1101Radio::close------------------------------------
+    def close(self):
+        with self.lock:
+            try:
+                if self.transceiver != None:
+                    self.transceiver.__exit__(None, None, None)
+            except Exception as e1:
+                self.LogDebug("Error closing CC1101: " + str(e1))
+            self.transceiver = None
+
+    #---------------------CC1101Radio::getStatistics----------------------------
+    def getStatistics(self):
+        return {'spi': "%d.%d" % (self.spiBus, self.spiChipSelect), 'open': self.transceiver != None, 'configurations': self.configurations, 'verifications': self.verifications, 'errors': self.errors}
+
+#------------ PigpioTransmitter class -----------------------------------------
+# Real radio: waves are played by pigpiod on the TX GPIO, which drives the
+# data input of the CC1101 in asynchronous transmission mode. Several
+# transmitters (one per CC1101) can share the same PigpioSession.
+class PigpioTransmitter(MyLog):
+    MaxChainPulses = 6000 # maximum number of pulses created for one wave chain
+    MaxChainCommands = 600 # size of pigpio's wave chain command buffer
+    MaxChainLoops = 20 # loop counters of one wave chain, one per frame repeated more than once
+
+    #---------------------PigpioTransmitter::__init__---------------------------
+    def __init__(self, gpio, log = None, spiBus = 0, spiChipSelect = 0, session = None):
+        super(PigpioTransmitter, self).__init__()
+        if log != None:
+            self.log = log
+        self.gpio = gpio
+        self.ownSession = session == None
+        self.pigpioSession = PigpioSession(log = self.log) if session == None else session
+        self.pigpioSession.addOutput(gpio)
+        self.radio = CC1101Radio(log = self.log, spiBus = spiBus, spiChipSelect = spiChipSelect)
+
+    #---------------------PigpioTransmitter::open-------------------------------
+    def open(self):
+        self.pigpioSession.get()
+        try:
+            self.radio.open()
+        except Exception as e1:
+            self.LogError("Not able to configure the CC1101 transceiver, will retry on first command: " + str(e1))
+
+    #---------------------PigpioTransmitter::upload-----------------------------
+    # Creates a wave in pigpiod ahead of time. The handle can be passed to send()
+    # instead of the pulse list until it is released.
+    def upload(self, wf):
+        pi = self.pigpioSession.get()
+        with self.pigpioSession.waveLock:
+            pi.wave_add_new()
+            pi.wave_add_generic(wf)
+            return (self.pigpioSession.connects, pi.wave_create())
+
+    #---------------------PigpioTransmitter::isValid----------------------------
+    # Waves do not survive a reconnect, pigpiod may have been restarted
+    def isValid(self, handle):
+        return handle[0] == self.pigpioSession.connects and self.pigpioSession.pi != None
+
+    #---------------------PigpioTransmitter::release----------------------------
+    def release(self, handle):
+        try:
+            with self.pigpioSession.waveLock:
+                if self.isValid(handle):
+                    self.pigpioSession.pi.wave_delete(handle[1])
+        except Exception as e1:
+            self.LogDebug("Error deleting wave: " + str(e1))
+
+    #---------------------PigpioTransmitter::send-------------------------------
+    # Sends a list of (LoopedWave, durationMicros) back to back and returns
+    # when done. first and repeat of every LoopedWave are created as waves (or
+    # already uploaded), the repeats are a loop of the wave chain:
+    # [first, 255, 0, repeat, 255, 1, repeats low, repeats high]
+    # The wave engine is shared with the other radios on the same pigpiod, so
+    # their airtime does not overlap.
+    def send(self, waves):
+        pi = self.pigpioSession.get()
+
+        # split the burst in chains that fit into pigpio's wave memory, chain
+        # command buffer and loop counters
+        chains = [[]]
+        chainPulses = 0
+        chainCommands = 0
+        chainLoops = 0
+        for looped, duration in waves:
+            if looped.repeats > MAX_CHAIN_LOOPS:
+                raise ValueError("Too many repetitions: " + str(looped.repeats + 1))
+            pulses = sum(len(wf) for wf in (looped.first, looped.repeat) if isinstance(wf, list))
+            loops = 1 if looped.repeats > 1 else 0
+            if ((chainPulses + pulses > self.MaxChainPulses) or (chainCommands + 8 > self.MaxChainCommands) or (chainLoops + loops > self.MaxChainLoops)) and (len(chains[-1]) > 0):
+                chains.append([])
+                chainPulses = 0
+                chainCommands = 0
+                chainLoops = 0
+            chains[-1].append((looped, duration))
+            chainPulses += pulses
+            chainCommands += 8
+            chainLoops += loops
+
+        with self.pigpioSession.waveLock, self.radio.transmission():
+            pi.wave_add_new()
+            for chain in chains:
+                commands = []
+                created = []
+                try:
+                    for looped, duration in chain:
+                        commands.append(self.waveId(pi, looped.first, created))
+                        if looped.repeats == 1:
+                            commands.append(self.waveId(pi, looped.repeat, created))
+                        elif looped.repeats > 1:
+                            commands += [255, 0, self.waveId(pi, looped.repeat, created), 255, 1, looped.repeats & 0xFF, looped.repeats >> 8]
+                    if len(commands) == 1:
+                        pi.wave_send_once(commands[0])
+                    else:
+                        pi.wave_chain(commands)
+                    self.pigpioSession.waitForWave(pi, sum(duration for looped, duration in chain))
+                finally:
+                    for wid in created:
+                        pi.wave_delete(wid)
+
+    #---------------------PigpioTransmitter::waveId-----------------------------
+    # Wave id of a pulse list (created now and added to created) or of an
+    # uploaded handle
+    def waveId(self, pi, wf, created):
+        if isinstance(wf, list):
+            pi.wave_add_generic(wf)
+            created.append(pi.wave_create())
+            return created[-1]
+        if not self.isValid(wf):
+            raise Exception("Uploaded wave is no longer valid")
+        return wf[1]
+
+    #---------------------PigpioTransmitter::close------------------------------
+    def close(self):
+        self.radio.close()
+        if self.ownSession:
+            self.pigpioSession.close()
+
+    #---------------------PigpioTransmitter::getStatistics----------------------
+    def getStatistics(self):
+        return {'pigpio': self.pigpioSession.getStatistics(), 'cc1101': self.radio.getStatistics()}
+
+#------------ SimulatedTransmitter class --------------------------------------
+# Stand-in for the radio when there is no pigpiod / CC1101, e.g. to run the
+# daemon and measure it on a normal Linux box. Nothing is sent, the pulse
+# trains are recorded and the airtime of the real radio is spent sleeping.
+class SimulatedTransmitter(MyLog):
+
+    #---------------------SimulatedTransmitter::__init__------------------------
+    def __init__(self, gpio, log = None, size = 100, spiBus = 0, spiChipSelect = 0):
+        super(SimulatedTransmitter, self).__init__()
+        if log != None:
+            self.log = log
+        self.gpio = gpio
+        self.spi = "%d.%d" % (spiBus, spiChipSelect)
+        self.transmissions = collections.deque(maxlen = size)
+        self.uploaded = {}
+        self.handles = itertools.count(1)
+        self.bursts = 0
+        self.pulses = 0
+
+    #---------------------SimulatedTransmitter::open----------------------------
+    def open(self):
+        self.LogInfo("Using the simulated radio on GPIO " + str(self.gpio) + ", SPI " + self.spi + ", nothing will be sent")
+
+    #---------------------SimulatedTransmitter::upload--------------------------
+    def upload(self, wf):
+        handle = next(self.handles)
+        self.uploaded[handle] = wf
+        return handle
+
+    #---------------------SimulatedTransmitter::isValid-------------------------
+    def isValid(self, handle):
+        return handle in self.uploaded
+
+    #---------------------SimulatedTransmitter::release-------------------------
+    def release(self, handle):
+        self.uploaded.pop(handle, None)
+
+    #---------------------SimulatedTransmitter::send----------------------------
+    # Records the LoopedWave of every frame with its uploaded waves resolved;
+    # like pigpiod, the repeats are not unrolled
+    def send(self, waves):
+        waves = [(looped._replace(first = self.resolve(looped.first), repeat = self.resolve(looped.repeat)), duration) for looped, duration in waves]
+        self.transmissions.append((time.time(), [looped for looped, duration in waves]))
+        self.bursts += 1
+        self.pulses += sum(len(looped.first) + len(looped.repeat) for looped, duration in waves)
+        time.sleep(sum(duration for looped, duration in waves) / 1e6)
+
+    #---------------------SimulatedTransmitter::resolve-------------------------
+    def resolve(self, wf):
+        return wf if isinstance(wf, list) else self.uploaded[wf]
+
+    #---------------------SimulatedTransmitter::getTransmissions----------------
+    # Recorded bursts as (time, [pulse list of every frame]), the repeats
+    # unrolled
+    def getTransmissions(self):
+        return [(timestamp, [looped.expand() for looped in frames]) for timestamp, frames in list(self.transmissions)]
+
+    #---------------------SimulatedTransmitter::close---------------------------
+    def close(self):
+        pass
+
+    #---------------------SimulatedTransmitter::getStatistics-------------------
+    def getStatistics(self):
+        return {'simulated': {'spi': self.spi, 'bursts': self.bursts, 'pulses': self.pulses}}
+
+#---------- createTransmitter -------------------------------------------------
+def createTransmitter(kind, gpio, log = None, spiBus = 0, spiChipSelect = 0, session = None):
+    if kind == "simulated":
+        return SimulatedTransmitter(gpio, log = log, spiBus = spiBus, spiChipSelect = spiChipSelect)
+    elif kind == "pigpio":
+        return PigpioTransmitter(gpio, log = log, spiBus = spiBus, spiChipSelect = spiChipSelect, session = session)
+    raise ValueError("%s is not a valid value for Transmitter." % kind)
+
+#---------- gatherFutures -----------------------------------------------------
+# Single future for several radio jobs: done when all of them are, with the
+# list of their results, the first exception, or cancelled if one was.
+def gatherFutures(futures):
+    if len(futures) == 1:
+        return futures[0]
+    combined = Future()
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0 or combined.cancelled():
+                return
+        if any(f.cancelled() for f in futures):
+            combined.cancel()
+        elif any(f.exception() != None for f in futures):
+            combined.set_exception(next(f.exception() for f in futures if f.exception() != None))
+        else:
+            combined.set_result([f.result() for f in futures])
+
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+#------------ RadioQueue class ------------------------------------------------
+# Single worker thread owning the radio. Jobs are queued with a priority and
+# run one after the other, lowest priority value first; jobs of the same
+# priority keep their order. When the queue is empty the idle function is
+# called, so background work is done in the radio thread too. A transmission in progress is never interrupted,
+# but an interactive command overtakes every scheduled one still waiting.
+class RadioQueue(threading.Thread, MyLog):
+    PriorityInteractive = 0
+    PriorityScheduled = 10
+
+    #---------------------RadioQueue::__init__----------------------------------
+    def __init__(self, log = None, name = "Radio", idle = None):
+        threading.Thread.__init__(self, name=name)
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        if log != None:
+            self.log = log
+        self.idle = idle
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.statsLock = threading.Lock()
+        self.maxDepth = 0
+        self.waitStatistics = {}
+
+    #---------------------RadioQueue::submit------------------------------------
+    # Queues function(*args) and returns a concurrent.futures.Future for its result
+    def submit(self, function, args = (), priority = PriorityInteractive):
+        future = Future()
+        self.queue.put((priority, next(self.sequence), time.monotonic(), future, function, args))
+        with self.statsLock:
+            self.maxDepth = max(self.maxDepth, self.queue.qsize())
+        return future
+
+    #---------------------RadioQueue::run---------------------------------------
+    def run(self):
+        idleWork = False
+        idleRetryTime = 0
+        while not self.shutdown_flag.is_set():
+            try:
+                priority, sequence, queueTime, future, function, args = self.queue.get(timeout = 0.01 if idleWork else 0.5)
+            except queue.Empty:
+                # nothing to send, do some background work if there is any;
+                # it returns True as long as more work is left
+                idleWork = False
+                if (self.idle != None) and (time.monotonic() >= idleRetryTime):
+                    try:
+                        idleWork = self.idle()
+                    except Exception as e1:
+                        self.LogError("Radio idle work failed, retrying in a minute: " + str(e1))
+                        idleRetryTime = time.monotonic() + 60
+                continue
+
+            self.recordWait(priority, time.monotonic() - queueTime)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e1:
+                self.LogError("Radio job failed: " + str(e1))
+                future.set_exception(e1)
+
+        # fail what is still waiting, nobody is going to send it anymore
+        while True:
+            try:
+                future = self.queue.get_nowait()[3]
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(Exception("Radio queue was shut down"))
+        return
+
+    #---------------------RadioQueue::recordWait--------------------------------
+    def recordWait(self, priority, waitTime):
+        with self.statsLock:
+            stats = self.waitStatistics.setdefault(priority, {'jobs': 0, 'totalWait': 0.0, 'maxWait': 0.0})
+            stats['jobs'] += 1
+            stats['totalWait'] += waitTime
+            stats['maxWait'] = max(stats['maxWait'], waitTime)
+
+    #---------------------RadioQueue::getStatistics-----------------------------
+    def getStatistics(self):
+        with self.statsLock:
+            waits = {}
+            for priority, stats in self.waitStatistics.items():
+                waits[str(priority)] = {'jobs': stats['jobs'], 'averageWait': stats['totalWait'] / stats['jobs'], 'maxWait': stats['maxWait']}
+            return {'depth': self.queue.qsize(), 'maxDepth': self.maxDepth, 'wait': waits}
+
+#------------ RadioChannel class ---------------------------------------------
+# One radio of the pool: its transmitter, the encoder for its TX GPIO and the
+# queue of the thread owning it
+class RadioChannel(object):
+
+    #---------------------RadioChannel::__init__--------------------------------
+    def __init__(self, name, transmitter, encoder, radioQueue):
+        self.name = name
+        self.transmitter = transmitter
+        self.encoder = encoder
+        self.radioQueue = radioQueue
+
+#------------ RadioPool class -------------------------------------------------
+# All radios of the installation, each with its own queue and thread, so the
+# frames for shutters on different radios are prepared and sent independently.
+# Radios of the 'pigpio' kind share one connection to pigpiod; since pigpiod
+# has a single wave engine their airtime is serialized, the rest (rendering,
+# rolling codes, CC1101 handling, queueing) runs in parallel. Simulated radios
+# are fully parallel.
+class RadioPool(MyLog):
+
+    #---------------------RadioPool::__init__-----------------------------------
+    def __init__(self, kind, log = None):
+        super(RadioPool, self).__init__()
+        if log != None:
+            self.log = log
+        self.kind = kind
+        self.radios = collections.OrderedDict()
+        self.pigpioSession = PigpioSession(log = self.log) if kind == "pigpio" else None
+
+    #---------------------RadioPool::add----------------------------------------
+    # idle is called with the radio name when its queue is empty
+    def add(self, name, gpio, spiBus = 0, spiChipSelect = 0, idle = None):
+        transmitter = createTransmitter(self.kind, gpio, log = self.log, spiBus = spiBus, spiChipSelect = spiChipSelect, session = self.pigpioSession)
+        radioQueue = RadioQueue(log = self.log, name = "Radio " + name, idle = functools.partial(idle, name) if idle != None else None)
+        self.radios[name] = RadioChannel(name, transmitter, RTSEncoder(gpio), radioQueue)
+        return self.radios[name]
+
+    #---------------------RadioPool::get----------------------------------------
+    # Radio by name, the first one if there is no such radio
+    def get(self, name = None):
+        if name in self.radios:
+            return self.radios[name]
+        return next(iter(self.radios.values()))
+
+    #---------------------RadioPool::start--------------------------------------
+    def start(self):
+        for radio in self.radios.values():
+            if radio.radioQueue.ident == None:
+                radio.radioQueue.setDaemon(True)
+                radio.radioQueue.start()
+
+    #---------------------RadioPool::open---------------------------------------
+    # The radio threads are only started once the transmitters are open, so
+    # neither commands nor idle work reach pigpiod before it is running.
+    # Commands submitted before wait in their queue.
+    def open(self):
+        for radio in self.radios.values():
+            radio.transmitter.open()
+        self.start()
+
+    #---------------------RadioPool::submit-------------------------------------
+    # jobs is a list of (radio, function, args); each job is queued on its
+    # radio and a single future for all of them is returned
+    def submit(self, jobs, priority = RadioQueue.PriorityInteractive):
+        return gatherFutures([radio.radioQueue.submit(function, args, priority) for radio, function, args in jobs])
+
+    #---------------------RadioPool::stop---------------------------------------
+    def stop(self):
+        for radio in self.radios.values():
+            radio.radioQueue.shutdown_flag.set()
+        for radio in self.radios.values():
+            if radio.radioQueue.is_alive():
+                radio.radioQueue.join()
+
+    #---------------------RadioPool::close--------------------------------------
+    def close(self):
+        for radio in self.radios.values():
+            radio.transmitter.close()
+        if self.pigpioSession != None:
+            self.pigpioSession.close()
+
+    #---------------------RadioPool::getStatistics------------------------------
+    def getStatistics(self):
+        stats = {}
+        for name, radio in self.radios.items():
+            stats[name] = radio.transmitter.getStatistics()
+            stats[name].update({'gpio': radio.transmitter.gpio, 'queue': radio.radioQueue.getStatistics()})
+        return stats
+
+#------------ FrameTrace class ------------------------------------------------
+# Opt-in diagnostic: keeps the last frames sent in memory. Recording a frame
+# only stores its raw fields, formatting is done when the trace is read.
+class FrameTrace(object):
+
+    #---------------------FrameTrace::__init__----------------------------------
+    def __init__(self, enabled = False, size = 100):
+        self.enabled = enabled
+        self.frames = collections.deque(maxlen = size)
+
+    #---------------------FrameTrace::record------------------------------------
+    def record(self, shutterId, button, code, repetition, frame):
+        self.frames.append((time.time(), shutterId, button, code, repetition, bytes(frame)))
+
+    #---------------------FrameTrace::getFrames---------------------------------
+    def getFrames(self):
+        frames = []
+        for timestamp, shutterId, button, code, repetition, frame in list(self.frames):
+            frames.append({'time': time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(timestamp)),
+                           'remote': shutterId,
+                           'button': "0x%0.2X" % button,
+                           'code': code,
+                           'repetition': repetition,
+                           'frame': " ".join("0x%0.2X" % octet for octet in frame)})
+        return frames
+
+#------------ TransmitStatistics class ----------------------------------------
+# CPU time, airtime and wall time used per transmission
+class TransmitStatistics(object):
+
+    #---------------------TransmitStatistics::__init__--------------------------
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transmissions = 0
+        self.cpuTime = 0.0
+        self.lastCpuTime = 0.0
+        self.maxCpuTime = 0.0
+        self.airTime = 0.0
+        self.wallTime = 0.0
+
+    #---------------------TransmitStatistics::record----------------------------
+    def record(self, cpuTime, airTime, wallTime):
+        with self.lock:
+            self.transmissions += 1
+            self.cpuTime += cpuTime
+            self.lastCpuTime = cpuTime
+            self.maxCpuTime = max(self.maxCpuTime, cpuTime)
+            self.airTime += airTime
+            self.wallTime += wallTime
+
+    #---------------------TransmitStatistics::getStatistics---------------------
+    def getStatistics(self):
+        with self.lock:
+            return {'transmissions': self.transmissions,
+                    'cpuTime': self.cpuTime,
+                    'lastCpuTime': self.lastCpuTime,
+                    'maxCpuTime': self.maxCpuTime,
+                    'averageCpuTime': self.cpuTime / self.transmissions if self.transmissions else 0.0,
+                    'airTime': self.airTime,
+                    'wallTime': self.wallTime}
+
+#---------- benchmark ---------------------------------------------------------
+# Pulse list construction as it was done before the templates were introduced,
+# kept as a reference for the benchmark only.
+def _renderUncached(frame, repetition, gpio):
+    wf = []
+    wf.append(Pulse(1<<gpio, 0, 9415))
+    wf.append(Pulse(0, 1<<gpio, 89565))
+    for i in range(2):
+        wf.append(Pulse(1<<gpio, 0, 2560))
+        wf.append(Pulse(0, 1<<gpio, 2560))
+    wf.append(Pulse(1<<gpio, 0, 4550))
+    wf.append(Pulse(0, 1<<gpio,  640))
+    for i in range (0, 56):
+        if ((frame[int(i/8)] >> (7 - (i%8))) & 1):
+            wf.append(Pulse(0, 1<<gpio, 640))
+            wf.append(Pulse(1<<gpio, 0, 640))
+        else:
+            wf.append(Pulse(1<<gpio, 0, 640))
+            wf.append(Pulse(0, 1<<gpio, 640))
+    wf.append(Pulse(0, 1<<gpio, 30415))
+    for j in range(1,repetition):
+        for i in range(7):
+            wf.append(Pulse(1<<gpio, 0, 2560))
+            wf.append(Pulse(0, 1<<gpio, 2560))
+        wf.append(Pulse(1<<gpio, 0, 4550))
+        wf.append(Pulse(0, 1<<gpio,  640))
+        for i in range (0, 56):
+            if ((frame[int(i/8)] >> (7 - (i%8))) & 1):
+                wf.append(Pulse(0, 1<<gpio, 640))
+                wf.append(Pulse(1<<gpio, 0, 640))
+            else:
+                wf.append(Pulse(1<<gpio, 0, 640))
+                wf.append(Pulse(0, 1<<gpio, 640))
+        wf.append(Pulse(0, 1<<gpio, 30415))
+    return wf
+
+def benchmark(iterations = 2000, gpio = 4):
+    encoder = RTSEncoder(gpio)
+    frame = encoder.obfuscate(encoder.addChecksum(encoder.buildFrame(0x2, 1234, 0x279621)))
+    results = {}
+    for repetition in (1, 2, 35):
+        if _renderUncached(frame, repetition, gpio) != encoder.render(frame, repetition):
+            raise Exception("Template rendering differs from reference for repetition " + str(repetition))
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            _renderUncached(frame, repetition, gpio)
+        before = (time.perf_counter() - start) / iterations
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            encoder.encode(0x2, 1234, 0x279621, repetition)
+        after = (time.perf_counter() - start) / iterations
+
+        results[repetition] = (before, after)
+    return results
+
+#---------- fuzz --------------------------------------------------------------
+# Round trip of random addresses, codes, buttons and repetitions
+def fuzz(count = 1000, seed = None, gpio = 4):
+    import random
+    rnd = random.Random(seed)
+    encoder = RTSEncoder(gpio)
+    decoder = RTSDecoder(gpio)
+    failures = []
+    start = time.perf_counter()
+    for n in range(count):
+        button = rnd.choice([0x1, 0x2, 0x4, 0x8, 0x3, 0x6, rnd.randint(0, 15)])
+        code = rnd.choice([0, 0xFFFF, rnd.randint(0, 0xFFFF)])
+        address = rnd.choice([0, 0xFFFFFF, rnd.randint(0, 0xFFFFFF)])
+        repetition = rnd.choice([1, 2, 3, rnd.randint(1, 35)])
+        errors = verifyRoundTrip(encoder, decoder, button, code, address, repetition)
+        if len(errors):
+            failures.append(((button, code, address, repetition), errors))
+    return failures, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Somfy RTS waveform micro-benchmark and encoder verification.')
+    parser.add_argument('-iterations', '-i', type=int, default=2000, help='Number of commands built per measurement')
+    parser.add_argument('-verify', '-v', type=int, metavar='COUNT', help='Encode and decode COUNT random commands instead of running the benchmark')
+    parser.add_argument('-seed', type=int, default=None, help='Seed of the random commands used by -verify')
+    args = parser.parse_args()
+
+    if args.verify != None:
+        failures, elapsed = fuzz(args.verify, args.seed)
+        for command, errors in failures[:10]:
+            print("button 0x%X code %d address 0x%06X repetition %d: %s" % (command + ("; ".join(errors),)))
+        print("%d of %d round trips failed (%.1f ms per round trip)" % (len(failures), args.verify, elapsed / max(1, args.verify) * 1e3))
+        sys.exit(1 if len(failures) else 0)
+
+    for repetition, (before, after) in benchmark(args.iterations).items():
+        print("repetition %2d: %8.1f us/command before, %8.1f us/command after (x%.1f)" % (repetition, before * 1e6, after * 1e6, before / after))
@@ -7,15 +7,16 @@ import re
 import locale
 import time
 import datetime
-import ephem
-import pigpio
 import socket
 import signal, atexit, subprocess, traceback
 import logging, logging.handlers
 import threading
+import heapq
+import itertools
 
 try:
     from mylog import MyLog
+    from myastro import AstroCache
 except Exception as e1:
     print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
     print("Error: " + str(e1))
@@ -27,7 +28,8 @@ class Event:
     ## repeatType: String: 'once' or 'weekday'
     ## repeatValue: Date in format "YYYY/MM/DD" or Array ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
     ## timeType: String: 'clock' or 'astro' are valid values
-    ## timeValue: String: Time in format "HH:MM" or values 'sunset' or 'sunrise' or 'sunset+MIN', 'sunset-MIN', 'sunrise+MIN', 'sunrise-MIN'
+    ## timeValue: String: Time in format "HH:MM" or "HH:MM:SS" or values 'sunset' or 'sunrise' or 'sunset+MIN', 'sunset-MIN', 'sunrise+MIN', 'sunrise-MIN' (MIN may be MIN:SEC)
+    ##            'dawn' and 'dusk' (civil twilight) can be used like 'sunrise' and 'sunset'
     ## shutterAction: String: 'up', 'down' or 'stop' (My-Position) are valid values. If this is followed by an integer, this indicates the duration of the operation
     ## shutterIds: Array of shutterIds to operate
 
@@ -51,10 +53,11 @@ class Event:
             raise ValueError("%s is not a valid value for TIMETYPE." % timeType)
         self.timeType = timeType
 
-        if (timeType == "clock") and not time.strptime(timeValue, '%H:%M'):
+        if (timeType == "clock") and not re.match('^\d{1,2}:\d{1,2}(:\d{1,2})?$', timeValue):
             raise ValueError("%s is not a valid value for TIMEVALUE (clock)." % timeValue )
-        astro_parts = re.split('\+|\-', timeValue)
-        if (timeType == "astro") and not ((astro_parts[0] in ('sunset', 'sunrise')) and ((len(astro_parts) == 1) or (astro_parts[1] == None or int(astro_parts[1])))):
+        if (timeType == "clock") and not time.strptime(timeValue, '%H:%M:%S' if timeValue.count(":") == 2 else '%H:%M'):
+            raise ValueError("%s is not a valid value for TIMEVALUE (clock)." % timeValue )
+        if (timeType == "astro") and not re.match('^(sunset|sunrise|dawn|dusk)([+-]\d+(:\d{1,2})?)?$', timeValue):
             raise ValueError("%s is not a valid value for TIMEVALUE (astro)." % timeValue)
         self.timeValue = timeValue
 
@@ -65,6 +68,23 @@ class Event:
 
         self.shutterIds = shutterIds
         
+    # Time of day of a clock event
+    def getClockTime(self):
+        parts = [int(part) for part in self.timeValue.split(":")]
+        return datetime.time(parts[0], parts[1], parts[2] if len(parts) > 2 else 0)
+
+    # 'sunrise', 'sunset', 'dawn' or 'dusk' and the offset of an astro event
+    def getAstroOffset(self):
+        match = re.match('^(sunset|sunrise|dawn|dusk)(([+-])(\d+)(:(\d{1,2}))?)?$', self.timeValue)
+        offset = datetime.timedelta(minutes = int(match.group(4) or 0), seconds = int(match.group(6) or 0))
+        return match.group(1), -offset if match.group(3) == '-' else offset
+
+    # True if the event takes place on day (a datetime.date)
+    def isOnDay(self, day):
+        if self.repeatType == 'weekday':
+            return ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'][day.weekday()] in self.repeatValue
+        return day.strftime('%Y/%m/%d') == self.repeatValue
+
     def prettyprint(self):
         outstr  = "active        : "+str(self.active)+"\n"
         outstr += "repeatType    : "+str(self.repeatType)+"\n"
@@ -85,6 +105,9 @@ class Schedule(MyLog):
         self.config = config
 
         self.schedule = {}
+        # notifies the scheduler of every change
+        self.changed = threading.Condition()
+        self.version = 0
         self.setUpdateTime()
         
     def addEvent(self, id, evt):
@@ -247,18 +270,40 @@ class Schedule(MyLog):
         return obj
 
     def setUpdateTime(self):
-        self.updateTime = int(time.time())
+        with self.changed:
+            self.updateTime = int(time.time())
+            self.version += 1
+            self.changed.notify_all()
 
     def getUpdateTime(self):
         return self.updateTime
+
+    def getVersion(self):
+        return self.version
+
+    # Waits at most timeout seconds for a change after version, returns the
+    # current version
+    def waitForUpdate(self, version, timeout = None):
+        with self.changed:
+            if self.version == version:
+                self.changed.wait(timeout)
+            return self.version
         
 
 class Scheduler(threading.Thread, MyLog):
+    # The thread sleeps until the next event is due or the schedule changes. It
+    # wakes up at least once per MaxSleep seconds anyway, the wall clock may be
+    # set (NTP after a boot without RTC, daylight saving time) while it sleeps.
+    MaxSleep = 3600
+    # seconds between the repetitions of a full move
+    RepeatInterval = 5
+    # seconds an event may be late and still run; beyond that the clock jumped
+    # forward (NTP, suspend) and the missed occurrences are skipped
+    MaxLateness = 120
 
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
         threading.Thread.__init__(self, group=group, target=target, name="Scheduler")
         self.shutdown_flag = threading.Event()
-        
         self.args = args
         self.kwargs = kwargs
         if kwargs["log"] != None:
@@ -266,102 +311,163 @@ class Scheduler(threading.Thread, MyLog):
         self.schedule = kwargs["schedule"]
         self.shutter = kwargs["shutter"]
         self.config = kwargs["config"]
-        self.weekday = datetime.datetime.today().weekday()
-        self.lastScheduleUpdateTime = 0
-        self.currentSchedule = {}
+        self.scheduleVersion = None
+        self.heap = []          # [time, sequence, function, args], time is a datetime
+        self.sequence = itertools.count()
+        # sun times of the whole year, computed again when the location changes
+        self.astro = AstroCache(self.config.AstroFile, log = self.log)
 
-        self.homeLocation = ephem.Observer()
         locale.setlocale(locale.LC_TIME,'')
         return
 
+    # Sunrise, sunset, dawn and dusk (local datetimes) of day
+    def getSunTimes(self, day):
+        return self.astro.getSunTimes(day, self.config.Latitude, self.config.Longitude)
+
+    # Time of the event on day, as a datetime, None if the sun does not rise or set that day
+    def getEventTime(self, event, day):
+        if event.timeType == "clock":
+            return datetime.datetime.combine(day, event.getClockTime())
+        sun, offset = event.getAstroOffset()
+        sunTime = self.getSunTimes(day)[sun]
+        return sunTime + offset if sunTime != None else None
+
+    # First time the event takes place after after, None if it never does again
+    def getNextTime(self, event, after):
+        if event.active != "active":
+            return None
+        if event.repeatType == 'once':
+            days = [datetime.datetime.strptime(event.repeatValue, '%Y/%m/%d').date()]
+        else:
+            # an offset may move the event to the day before or after
+            days = [after.date() + datetime.timedelta(days = i) for i in range(-1, 9)]
+        for day in days:
+            if event.isOnDay(day):
+                eventTime = self.getEventTime(event, day)
+                if (eventTime != None) and (eventTime > after):
+                    return eventTime
+        return None
+
+    def push(self, eventTime, function, *args):
+        heapq.heappush(self.heap, [eventTime, next(self.sequence), function, args])
+
+    # Rebuilds the heap with the next time of every event
     def updateSchedule(self):
-        weekDays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-        
-        self.homeLocation.lat = str(self.config.Latitude)
-        self.homeLocation.lon = str(self.config.Longitude)
-        self.homeLocation.date = datetime.datetime.now().strftime("%Y/%m/%d 00:00:00")
-        sunrise = ephem.localtime(self.homeLocation.next_rising(ephem.Sun()))
-        sunset = ephem.localtime(self.homeLocation.next_setting(ephem.Sun()))
-        weekday = weekDays[datetime.datetime.today().weekday()]
-        date    = datetime.datetime.today().strftime('%Y/%m/%d')
-        self.LogInfo("Today is "+date+", a "+weekday+", Sunrise is at "+str(sunrise.time())+" and Sunset is at "+ str(sunset.time()));
-
-        self.currentSchedule = {}
-        for id, event in self.schedule.getSchedule().items():
-            if ((event.active == "active") and (((event.repeatType == 'weekday') and (weekday in event.repeatValue)) or ((event.repeatType == 'once') and (date == event.repeatValue)))):
-                if (event.timeType == "clock"):
-                    eventTime = datetime.time(int(event.timeValue.split(":")[0]), int(event.timeValue.split(":")[1]), 0)
-                elif ((event.timeType == "astro") and (event.timeValue.startswith("sunrise"))):
-                    eventTime = (sunrise + datetime.timedelta(minutes=int(event.timeValue[7:] or 0))).time()
-                elif ((event.timeType == "astro") and (event.timeValue.startswith("sunset"))):
-                    eventTime = (sunset + datetime.timedelta(minutes=int(event.timeValue[6:] or 0))).time()
-
-                if (eventTime > datetime.datetime.now().time()): 
-                    eventTimeStr = "%02d:%02d" % (eventTime.hour, eventTime.minute)
-                    if not eventTimeStr in self.currentSchedule:
-                        self.currentSchedule[eventTimeStr] = []
-                    self.currentSchedule[eventTimeStr].append([event.shutterIds, event.shutterAction])  
-        self.LogDebug(str(self.currentSchedule))
-    
+        now = datetime.datetime.now()
+        sunTimes = self.getSunTimes(now.date())
+        weekday = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'][now.weekday()]
+        self.LogInfo("Today is "+now.strftime('%Y/%m/%d')+", a "+weekday+", Sunrise is at "+str(sunTimes['sunrise'].time() if sunTimes['sunrise'] else None)+" and Sunset is at "+ str(sunTimes['sunset'].time() if sunTimes['sunset'] else None));
+
+        # repetitions of moves already started are kept
+        self.heap = [entry for entry in self.heap if entry[2] != self.runScheduledEvent]
+        heapq.heapify(self.heap)
+        for id, event in list(self.schedule.getSchedule().items()):
+            eventTime = self.getNextTime(event, now)
+            if eventTime != None:
+                self.push(eventTime, self.runScheduledEvent, id, event, eventTime)
+        self.LogDebug(str(sorted((entry[0].strftime('%Y/%m/%d %H:%M:%S'), entry[3][0]) for entry in self.heap if entry[2] == self.runScheduledEvent)))
+
+    # Runs the event and queues its next time, after now so that missed
+    # occurrences are not run one after another
+    def runScheduledEvent(self, id, event, eventTime):
+        now = datetime.datetime.now()
+        if (now - eventTime).total_seconds() > self.MaxLateness:
+            self.LogWarn("Skipping event " + str(id) + " due at " + eventTime.strftime('%Y/%m/%d %H:%M:%S') + ", the clock jumped forward")
+        else:
+            self.runEvent(event.shutterIds, event.shutterAction)
+        nextTime = self.getNextTime(event, max(eventTime, now))
+        if nextTime != None:
+            self.push(nextTime, self.runScheduledEvent, id, event, nextTime)
+
+    def stop(self):
+        self.shutdown_flag.set()
+        # wakes the thread up
+        self.schedule.setUpdateTime()
+
+    def runEvent(self, shutterIds, shutterAction):
+        # Full moves of all shutters of the event are sent in one radio burst,
+        # partial moves are driven together as a scene
+        groupIds = []
+        sceneTargets = {}
+        for shutterId in shutterIds:
+            try:
+                self.LogInfo("Send action \""+shutterAction+"\" to shutterId \""+shutterId+"\" at " + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+                if (shutterAction.startswith("up")):
+                    s = shutterAction[2:].strip()
+                    s1 = int(s) if s else -1
+                    if (0 < s1 < 100):
+                        if (self.shutter.getPosition(shutterId) < s1):   #Is Shutter below requested Position?
+                            sceneTargets[shutterId] = s1
+                        else:
+                            self.LogWarn("Send action \""+shutterAction+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or above requested position")
+                    else :
+                        groupIds.append(shutterId)
+                elif (shutterAction.startswith("down")):
+                    s = shutterAction[4:].strip()
+                    s1 = int(s) if s else -1
+                    if (0 < s1 < 100):
+                        if (self.shutter.getPosition(shutterId) > s1):   #Is Shutter above requested Position?
+                            sceneTargets[shutterId] = s1
+                        else:
+                            self.LogWarn("Send action \""+shutterAction+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or below requested position")
+                    else :
+                        groupIds.append(shutterId)
+                elif (shutterAction.startswith("stop")):
+                    groupIds.append(shutterId)
+            except:
+                self.LogError ("Error: cannot open "+shutterId)
+                self.LogError (traceback.format_exc())
+
+        if len(sceneTargets) > 0:
+            try:
+                self.shutter.moveScene(sceneTargets, self.shutter.priorityScheduled, source = 'scheduler')
+            except:
+                self.LogError ("Error: cannot open "+str(list(sceneTargets)))
+                self.LogError (traceback.format_exc())
+
+        if len(groupIds) == 0:
+            return
+        self.runGroup(groupIds, shutterAction, self.config.SendRepeat if not shutterAction.startswith("stop") else 1)
+
+    # Full moves are sent repeat times, RepeatInterval seconds apart; the
+    # repetitions are queued so they do not hold back other events
+    def runGroup(self, groupIds, shutterAction, repeat):
+        try:
+            if (shutterAction.startswith("up")):
+                self.shutter.riseGroup(groupIds, self.shutter.priorityScheduled, source = 'scheduler')
+            elif (shutterAction.startswith("down")):
+                self.shutter.lowerGroup(groupIds, self.shutter.priorityScheduled, source = 'scheduler')
+            elif (shutterAction.startswith("stop")):
+                self.shutter.stopGroup(groupIds, self.shutter.priorityScheduled, source = 'scheduler')
+        except:
+            self.LogError ("Error: cannot open "+str(groupIds))
+            self.LogError (traceback.format_exc())
+        if repeat > 1:
+            self.push(datetime.datetime.now() + datetime.timedelta(seconds = self.RepeatInterval), self.runGroup, groupIds, shutterAction, repeat - 1)
+
     def run(self):
         # self.schedule.printSchedule()
         while not self.shutdown_flag.is_set():
-            currentScheduleUpdateTime = self.schedule.getUpdateTime();
-            if ((self.lastScheduleUpdateTime < currentScheduleUpdateTime) or (self.weekday != datetime.datetime.today().weekday())):
+            if self.scheduleVersion != self.schedule.getVersion():
+                self.scheduleVersion = self.schedule.getVersion()
                 self.updateSchedule()
-                self.weekday = datetime.datetime.today().weekday()
-                self.lastScheduleUpdateTime = currentScheduleUpdateTime
-               
-            ## check next event 
-            timeNow = datetime.datetime.now().time()
-            timeNowStr = "%02d:%02d" % (timeNow.hour, timeNow.minute)
-            eventsToDelete = [];
-            for eventTimeStr, eventDetails in self.currentSchedule.items():
-                if (eventTimeStr <= timeNowStr):
-                    for eventDetail in eventDetails:
-                        for shutterId in eventDetail[0]:
-                            try:
-                                self.LogInfo("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" at " + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-                                if (eventDetail[1].startswith("up")):
-                                    s = eventDetail[1][2:].strip()
-                                    s1 = int(s) if s else -1
-                                    if (0 < s1 < 100):
-                                        if (self.shutter.getPosition(shutterId) < s1):   #Is Shutter below requested Position?
-                                            self.shutter.risePartial(shutterId, s1)
-                                        else:
-                                            self.LogWarn("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or above requested position")                                      
-                                    else :  
-                                        for i in range(self.config.SendRepeat):
-                                            self.shutter.rise(shutterId)
-                                            time.sleep(5)
-                                elif (eventDetail[1].startswith("down")):
-                                    s = eventDetail[1][4:].strip()
-                                    s1 = int(s) if s else -1
-                                    if (0 < s1 < 100):
-                                        if (self.shutter.getPosition(shutterId) > s1):   #Is Shutter above requested Position?
-                                            self.shutter.lowerPartial(shutterId, s1)
-                                        else:
-                                            self.LogWarn("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or below requested position")                                         
-                                    else :  
-                                        for i in range(self.config.SendRepeat):
-                                            self.shutter.lower(shutterId)
-                                            time.sleep(5)
-                                elif (eventDetail[1].startswith("stop")):
-                                    self.shutter.stop(shutterId)
-                            except:
-              	                self.LogError ("Error: cannot open "+shutterId)
-              	                self.LogError (traceback.format_exc())
-                    eventsToDelete.append(eventTimeStr);    
-            for key in eventsToDelete:
+
+            now = datetime.datetime.now()
+            while len(self.heap) and (self.heap[0][0] <= now) and not self.shutdown_flag.is_set():
+                eventTime, sequence, function, args = heapq.heappop(self.heap)
+                self.LogDebug("Running event due at " + eventTime.strftime('%H:%M:%S.%f') + ", late by " + "%.3f" % (now - eventTime).total_seconds() + " seconds")
                 try:
-                    del self.currentSchedule[key] 
-                except KeyError:
-                    pass
-            if (len(eventsToDelete) > 0):
-                self.LogDebug(str(self.currentSchedule))
-         
-            self.shutdown_flag.wait(60 - datetime.datetime.now().time().second)
-            
+                    function(*args)
+                except:
+                    self.LogError ("Error running scheduled event")
+                    self.LogError (traceback.format_exc())
+                now = datetime.datetime.now()
+
+            timeout = self.MaxSleep
+            if len(self.heap):
+                timeout = min(timeout, (self.heap[0][0] - datetime.datetime.now()).total_seconds())
+            if timeout > 0:
+                self.schedule.waitForUpdate(self.scheduleVersion, timeout)
+
         self.LogError("Received Signal to shut down Scheduler thread")
         return
-
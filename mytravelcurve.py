@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import bisect
+from array import array
+
+#------------ TravelCurve class -----------------------------------------------
+# Position of a shutter against the seconds it has been travelling in one
+# direction, counted from the end stop the travel starts at (100 going down,
+# 0 going up). Roller shutters are not linear: the roll gets thinner while
+# going down and the slats close at the end, so the curve is calibrated with
+# a few measured points and interpolated linearly in between.
+#
+# The points are compiled once into sorted arrays, with the slope of every
+# segment, which map both ways: seconds to position and position to seconds.
+class TravelCurve(object):
+
+    #---------------------TravelCurve::__init__---------------------------------
+    # points is a list of (seconds, position), the first one at 0 seconds on the
+    # start end stop and the last one on the other end stop
+    def __init__(self, direction, points):
+        if direction not in ('up', 'down'):
+            raise ValueError("%s is not a valid direction." % direction)
+        points = sorted((float(seconds), float(position)) for seconds, position in points)
+        start, end = (100.0, 0.0) if direction == 'down' else (0.0, 100.0)
+        if (len(points) < 2) or (points[0] != (0.0, start)) or (points[-1][1] != end):
+            raise ValueError("Travel going %s must start at 0 seconds on position %d and end on position %d." % (direction, start, end))
+        sign = 1 if direction == 'up' else -1
+        for (t0, p0), (t1, p1) in zip(points, points[1:]):
+            if (t1 <= t0) or ((p1 - p0) * sign <= 0):
+                raise ValueError("Travel going %s is not monotone between %gs and %gs." % (direction, t0, t1))
+
+        self.direction = direction
+        self.duration = points[-1][0]
+        self.times = array('d', [t for t, p in points])
+        self.positions = array('d', [p for t, p in points])
+        # positions increasing along the travel, for the reverse lookup
+        self.distances = array('d', [(p - start) * sign for t, p in points])
+        self.slopes = array('d', [(p1 - p0) / (t1 - t0) for (t0, p0), (t1, p1) in zip(points, points[1:])])
+
+    #---------------------TravelCurve::linear-----------------------------------
+    # Curve of a shutter moving at constant speed
+    @classmethod
+    def linear(cls, direction, duration):
+        return cls(direction, [(0, 100 if direction == 'down' else 0), (duration, 0 if direction == 'down' else 100)])
+
+    #---------------------TravelCurve::parse------------------------------------
+    # From a config value "seconds:position, seconds:position, ..."
+    @classmethod
+    def parse(cls, direction, value):
+        points = []
+        for point in value.split(","):
+            seconds, position = point.split(":")
+            points.append((float(seconds), float(position)))
+        return cls(direction, points)
+
+    #---------------------TravelCurve::positionAt-------------------------------
+    def positionAt(self, seconds):
+        if seconds <= 0:
+            return self.positions[0]
+        if seconds >= self.duration:
+            return self.positions[-1]
+        index = bisect.bisect_right(self.times, seconds) - 1
+        return self.positions[index] + (seconds - self.times[index]) * self.slopes[index]
+
+    #---------------------TravelCurve::timeAt-----------------------------------
+    # Seconds after which the travel passes position
+    def timeAt(self, position):
+        distance = (position - self.positions[0]) * (1 if self.direction == 'up' else -1)
+        if distance <= 0:
+            return 0.0
+        if distance >= self.distances[-1]:
+            return self.duration
+        index = bisect.bisect_right(self.distances, distance) - 1
+        return self.times[index] + (position - self.positions[index]) / self.slopes[index]
+
+    #---------------------TravelCurve::travelTime-------------------------------
+    # Seconds to travel from position start to position end, 0 if end is not
+    # ahead in this direction
+    def travelTime(self, start, end):
+        return max(0.0, self.timeAt(end) - self.timeAt(start))
+
+    #---------------------TravelCurve::advance----------------------------------
+    # Position reached after travelling for seconds from position start
+    def advance(self, start, seconds):
+        return self.positionAt(self.timeAt(start) + seconds)
@@ -79,7 +79,7 @@ class FlaskAppWrapper(MyLog):
             # self.LogDebug("JSON: "+str(request.get_json()))
             # self.LogDebug("RAW: "+str(request.get_data()))
             command = args[1]['command']
-            if command in ["up", "down", "stop", "program", "press", "getConfig", "addSchedule", "editSchedule", "deleteSchedule", "addShutter", "editShutter", "deleteShutter", "setLocation" ]:
+            if command in ["up", "down", "stop", "program", "press", "getConfig", "addSchedule", "editSchedule", "deleteSchedule", "addShutter", "editShutter", "deleteShutter", "setLocation", "getStatistics", "getFrameTrace", "getPositions", "moveScene", "getMotionHistory" ]:
                 self.LogInfo("processing Command \"" + command + "\" with parameters: "+str(request.values))
                 result = getattr(self, command)(request.values)
                 return Response(json.dumps(result), status=200)
@@ -122,7 +122,7 @@ class FlaskAppWrapper(MyLog):
         self.LogDebug("rise shutter \""+shutter+"\"")
         if (not shutter in self.config.Shutters):
             return {'status': 'ERROR', 'message': 'Shutter does not exist'}
-        self.shutter.rise(shutter)
+        self.shutter.rise(shutter, source = 'web')
         return {'status': 'OK'}
 
     def down(self, params):
@@ -132,7 +132,7 @@ class FlaskAppWrapper(MyLog):
         self.LogDebug("lower shutter \""+shutter+"\"")
         if (not shutter in self.config.Shutters):
             return {'status': 'ERROR', 'message': 'Shutter does not exist'}
-        self.shutter.lower(shutter)
+        self.shutter.lower(shutter, source = 'web')
         return {'status': 'OK'}
 
     def stop(self, params):
@@ -142,7 +142,21 @@ class FlaskAppWrapper(MyLog):
         self.LogDebug("stop shutter \""+shutter+"\"")
         if (not shutter in self.config.Shutters):
             return {'status': 'ERROR', 'message': 'Shutter does not exist'}
-        self.shutter.stop(shutter)
+        self.shutter.stop(shutter, source = 'web')
+        return {'status': 'OK'}
+
+    # shutterIds[] and positions[] list the shutters of the scene and their targets
+    def moveScene(self, params):
+        if not self.validatePassword():
+            return {'status': 'ERROR'}
+        shutterIds = params.getlist('shutterIds[]')
+        positions = params.getlist('positions[]')
+        self.LogDebug("move scene \""+str(shutterIds)+"\" to \""+str(positions)+"\"")
+        if (len(shutterIds) != len(positions)) or not all(self.isfloat(position) for position in positions):
+            return {'status': 'ERROR', 'message': 'One position per shutter required'}
+        if not all(shutter in self.config.Shutters for shutter in shutterIds):
+            return {'status': 'ERROR', 'message': 'Shutter does not exist'}
+        self.shutter.moveScene(dict(zip(shutterIds, [float(position) for position in positions])), source = 'web')
         return {'status': 'OK'}
 
     def program(self, params):
@@ -200,9 +214,11 @@ class FlaskAppWrapper(MyLog):
             self.LogDebug("got a new shutter id: "+id)
             self.config.WriteValue(str(id), str(name)+",True,"+str(duration), section="Shutters");
             self.config.WriteValue(str(id), str(code), section="ShutterRollingCodes");
+            self.config.resetCode(str(id), code)
             self.config.WriteValue(str(id), str(None), section="ShutterIntermediatePositions");
             self.config.ShuttersByName[name] = id
-            self.config.Shutters[id] = {'name': name, 'code': code, 'duration': duration, 'intermediatePosition': None}
+            self.config.Shutters[id] = {'name': name, 'code': code, 'duration': duration, 'durationDown': self.config.ParseDuration(duration), 'durationUp': self.config.ParseDuration(duration), 'intermediatePosition': None, 'radio': None}
+            self.config.Shutters[id].update(self.config.LoadTravelCurves(id))
             return {'status': 'OK', 'id': id}
 
     def editShutter(self, params):
@@ -233,6 +249,9 @@ class FlaskAppWrapper(MyLog):
             self.config.ShuttersByName['name'] = id
             self.config.Shutters[id]['name'] = name
             self.config.Shutters[id]['duration'] = duration
+            self.config.Shutters[id]['durationDown'] = self.config.ParseDuration(duration)
+            self.config.Shutters[id]['durationUp'] = self.config.ParseDuration(duration)
+            self.config.Shutters[id].update(self.config.LoadTravelCurves(id))
             return {'status': 'OK'}
 
     def deleteShutter(self, params):
@@ -270,6 +289,24 @@ class FlaskAppWrapper(MyLog):
         self.LogDebug("getConfig called, sending: "+json.dumps(obj))
         return obj
 
+    def getStatistics(self, params):
+        obj = self.shutter.getStatistics()
+        self.LogDebug("getStatistics called, sending: "+json.dumps(obj))
+        return obj
+
+    def getFrameTrace(self, params):
+        return {'enabled': self.shutter.frameTrace.enabled, 'frames': self.shutter.frameTrace.getFrames()}
+
+    def getPositions(self, params):
+        return self.shutter.getPositions()
+
+    # Recorded motions and their totals, of all shutters or of the one given
+    def getMotionHistory(self, params):
+        shutter = params.get('shutter', None, type=str)
+        if (shutter != None) and (not shutter in self.config.Shutters):
+            return {'status': 'ERROR', 'message': 'Shutter does not exist'}
+        return {'history': self.shutter.history.getHistory(shutter), 'statistics': self.shutter.history.getStatistics(shutter)}
+
     def generate_adhoc_ssl_context(self):
         """Generates an adhoc SSL context for the development server."""
         #        crypto = _get_openssl_crypto_module()
@@ -8,12 +8,15 @@ import locale
 import time
 import datetime
 import ephem
-import pigpio
 import socket
 import signal, atexit, traceback
 import logging, logging.handlers
 import threading
-import cc1101
+import collections
+import functools
+import random
+import math
+from concurrent.futures import Future, CancelledError
 
 try:
     from myconfig import MyConfig
@@ -25,6 +28,11 @@ try:
     from mywebserver import FlaskAppWrapper
     from myalexa import Alexa
     from mymqtt import MQTT
+    from myradio import RTSEncoder, TransmitStatistics, RadioQueue, RadioPool, FrameTrace, gatherFutures
+    from mymotion import MotionTracker
+    from mypositionstore import PositionStore, PositionRecord
+    from myevents import PositionEventBus
+    from myhistory import MotionHistory
     from shutil import copyfile
 except Exception as e1:
     print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
@@ -38,310 +46,754 @@ class Shutter(MyLog):
     buttonDown = 0x4
     buttonProg = 0x8
 
-    class ShutterState: # Definition of one shutter state
-        position = None # as percentage: 0 = closed (down), 100 = open (up)
-        lastCommandTime = None # get using time.monotonic()
-        lastCommandDirection = None # 'up' or 'down' or None
+    #Buttons rendered in advance and budget of pulses kept in pigpiod for them
+    prerenderButtons = (buttonUp, buttonDown, buttonStop)
+    maxPrerenderedPulses = 4000
+
+    #Radio queue priorities
+    priorityInteractive = RadioQueue.PriorityInteractive
+    priorityScheduled = RadioQueue.PriorityScheduled
 
-        def __init__(self, initPosition = None):
-            self.position = initPosition
-            self.lastCommandTime = time.monotonic()
+    #Seconds between two position reports while a shutter moves
+    positionReportInterval = 1.0
 
-        def registerCommand(self, commandDirection):
-            self.lastCommandDirection = commandDirection
-            self.lastCommandTime = time.monotonic()
+    class ShutterState: # Definition of one shutter state
+        # position: as percentage: 0 = closed (down), 100 = open (up). When moving, position at the start of the motion
+        # lastCommandTime: get using time.monotonic()
+        # lastCommandDirection: 'up' or 'down' or None
+        # motionCurve: TravelCurve of the shutter in lastCommandDirection
+        # motionTarget: position where the motion ends
+        # partialMotion: True if the motion ends with a stop sent by us
+        # source: who asked for the motion ('web', 'mqtt', ...), None if unknown
+        # wait: seconds between the request and the command being on the air
+        Motion = collections.namedtuple('Motion', ['position', 'lastCommandTime', 'lastCommandDirection', 'motionCurve', 'motionTarget', 'partialMotion', 'source', 'wait'])
+
+        # The state is an immutable Motion replaced as a whole on every change:
+        # readers take no lock and always see a consistent state, writers of
+        # the same shutter are serialized by its own lock.
+        # onMotionEnd(motion, position, endTime) is called with the lock held
+        # when a motion ends.
+        def __init__(self, initPosition = None, onMotionEnd = None):
+            self.lock = threading.RLock()
+            self.onMotionEnd = onMotionEnd
+            self.motion = self.Motion(initPosition, time.monotonic(), None, None, None, False, None, None)
+
+        position = property(lambda self: self.motion.position)
+        lastCommandTime = property(lambda self: self.motion.lastCommandTime)
+        lastCommandDirection = property(lambda self: self.motion.lastCommandDirection)
+        motionCurve = property(lambda self: self.motion.motionCurve)
+        motionTarget = property(lambda self: self.motion.motionTarget)
+        partialMotion = property(lambda self: self.motion.partialMotion)
+
+        # The position at the time of the command becomes the start of the new
+        # motion. startTime is when the motor got the command, now by default.
+        def registerCommand(self, commandDirection, curve = None, target = None, partial = False, startTime = None, source = None, wait = None):
+            with self.lock:
+                if startTime == None:
+                    startTime = time.monotonic()
+                previous = self.motion
+                self.motion = self.Motion(self.getLivePosition(startTime, previous), startTime, commandDirection, curve, target, partial, source, wait)
+                self.motionEnded(previous, self.motion.position, startTime)
+                return self.motion
+
+        # Position at rest, ends the motion. With commandTime, only if no other
+        # command was registered since. Returns True if the position was set.
+        def setPosition(self, position, commandTime = None):
+            with self.lock:
+                if (commandTime != None) and (self.motion.lastCommandTime != commandTime):
+                    return False
+                previous = self.motion
+                self.motion = self.motion._replace(position = position, lastCommandDirection = None)
+                self.motionEnded(previous, position, time.monotonic())
+                return True
+
+        def motionEnded(self, motion, position, endTime):
+            if (motion.lastCommandDirection != None) and (motion.position != None) and (self.onMotionEnd != None):
+                self.onMotionEnd(motion, position, endTime)
+
+        def restore(self, motion):
+            with self.lock:
+                self.motion = motion
+
+        # Position along the travel curve from the start of the motion, as a float
+        def getLivePosition(self, now = None, motion = None):
+            if motion == None:
+                motion = self.motion
+            if (motion.position == None) or (motion.lastCommandDirection == None) or (motion.motionCurve == None):
+                return motion.position
+            if now == None:
+                now = time.monotonic()
+            # now may have been taken before the motion was started
+            position = motion.motionCurve.advance(motion.position, max(0, now - motion.lastCommandTime))
+            if motion.lastCommandDirection == 'up':
+                return min(motion.motionTarget, position)
+            return max(motion.motionTarget, position)
+
+        def isMoving(self, now = None, motion = None):
+            if motion == None:
+                motion = self.motion
+            if (motion.position == None) or (motion.lastCommandDirection == None) or (motion.motionCurve == None):
+                return False
+            if now == None:
+                now = time.monotonic()
+            return now - motion.lastCommandTime < motion.motionCurve.travelTime(motion.position, motion.motionTarget)
 
     def __init__(self, log = None, config = None):
         super(Shutter, self).__init__()
-        self.lock = threading.Lock()
         if log != None:
             self.log = log
         if config != None:
             self.config = config
 
-        if self.config.TXGPIO != None:
-           self.TXGPIO=self.config.TXGPIO # 433.42 MHz emitter
-        else:
-           self.TXGPIO=24 # 433.42 MHz emitter on GPIO 4
-        self.frame = bytearray(7)
-        self.callback = []
+        # one or more 433.42 MHz emitters, each shutter is sent by its own one
+        self.radios = RadioPool(self.config.Transmitter, log = self.log)
+        for name, radio in self.config.Radios.items():
+            self.radios.add(name, radio['gpio'], radio['spiBus'], radio['spiChipSelect'], idle = self.prerender)
+        self.transmitStatistics = TransmitStatistics()
+        self.frameTrace = FrameTrace(enabled = self.config.TraceFrames)
+        # position changes are delivered to the callbacks by their own thread
+        self.events = PositionEventBus(log = self.log)
         self.shutterStateList = {}
         self.sutterStateLock = threading.Lock()
 
+        self.prerendered = {}
+        self.prerenderLock = threading.Lock()
+        self.prerenderedPulses = 0
+        self.prerenderHits = 0
+        self.prerenderMisses = 0
+
+        # bursts waiting for their radio, [priority, commands, dropped shutterIds]
+        self.pendingBursts = []
+        self.pendingLock = threading.Lock()
+
+        # expected end of the movements of all shutters
+        self.motionTracker = MotionTracker(log = self.log)
+        self.motionTracker.setDaemon(True)
+        self.motionTracker.start()
+
+        # last motions of every shutter, also kept across restarts
+        self.history = MotionHistory(self.config.MotionHistoryFile, self.config.MotionHistorySize, log = self.log)
+        try:
+            self.history.load(self.config.Shutters)
+        except Exception as e1:
+            self.LogError("Error reading motion history from " + str(self.config.MotionHistoryFile) + ": " + str(e1))
+        self.history.setDaemon(True)
+        self.history.start()
+
+        # positions survive a restart
+        self.positionStore = PositionStore(self.config.PositionFile, log = self.log)
+        self.restorePositions()
+        self.positionStore.setDaemon(True)
+        self.positionStore.start()
+
+    # The list of states is never modified, a new one is swapped in when a
+    # shutter is added, so looking up a state takes no lock
     def getShutterState(self, shutterId, initialPosition = None):
+        state = self.shutterStateList.get(shutterId)
+        if state != None:
+            return state
         with self.sutterStateLock:
             if shutterId not in self.shutterStateList:
-                self.shutterStateList[shutterId] = self.ShutterState(initialPosition)
+                states = dict(self.shutterStateList)
+                states[shutterId] = self.ShutterState(initialPosition, functools.partial(self.motionEnded, shutterId))
+                self.shutterStateList = states
             return self.shutterStateList[shutterId]
 
+    # Live position, interpolated while the shutter moves
     def getPosition(self, shutterId):
         state = self.getShutterState(shutterId, 0)
-        return state.position
-
-    def setPosition(self, shutterId, newPosition):
+        return state.getLivePosition()
+
+    # Position and motion of all known shutters
+    def getPositions(self):
+        now = time.monotonic()
+        positions = {}
+        for shutterId, state in self.shutterStateList.items():
+            motion = state.motion
+            positions[shutterId] = {'position': state.getLivePosition(now, motion), 'direction': motion.lastCommandDirection if state.isMoving(now, motion) else None}
+        return positions
+
+    # With commandTime, the position is only set if no other command was
+    # registered for the shutter since. Returns True if it was set.
+    def setPosition(self, shutterId, newPosition, commandTime = None):
         state = self.getShutterState(shutterId)
-        with self.sutterStateLock:
-            state.position = newPosition
-        for function in self.callback:
-            function(shutterId, newPosition)
-
-    def waitAndSetFinalPosition(self, shutterId, timeToWait, newPosition):
+        # under the lock, so the store and the subscribers get the changes in order
+        with state.lock:
+            if not state.setPosition(newPosition, commandTime):
+                return False
+            self.persistState(shutterId, state)
+            self.events.publish(shutterId, newPosition)
+            return True
+
+    # Queues the state for the position file, the motion start is stored as
+    # wall clock time so it can be followed up after a restart
+    def persistState(self, shutterId, state):
+        motion = state.motion
+        if motion.position == None:
+            return
+        commandTime = time.time() - (time.monotonic() - motion.lastCommandTime)
+        self.positionStore.update(shutterId, PositionRecord(motion.position, motion.lastCommandDirection, motion.partialMotion, motion.motionTarget, motion.motionCurve.duration if motion.motionCurve != None else None, commandTime))
+
+    # Restores the positions stored before the last shutdown. A motion still in
+    # progress is followed up from the time it started; if we had to send the
+    # stop of a partial move, it was never sent and the motor ran to the end.
+    def restorePositions(self):
+        try:
+            records = self.positionStore.load(self.config.Shutters)
+        except Exception as e1:
+            self.LogError("Not able to read the positions from " + self.config.PositionFile + ", starting without them: " + str(e1))
+            return
+        for shutterId, record in records.items():
+            state = self.getShutterState(shutterId, record.position)
+            if record.direction == None:
+                continue
+            target = record.target
+            if record.partial:
+                target = 0 if record.direction == 'down' else 100
+            curve = self.getTravelCurve(shutterId, record.direction)
+            state.restore(state.Motion(record.position, time.monotonic() - max(0, time.time() - record.commandTime), record.direction, curve, target, False, None, None))
+            if state.isMoving():
+                self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Still going " + record.direction + " since before the restart")
+                self.trackMotion(shutterId, curve.travelTime(state.getLivePosition(), target), target, state.lastCommandTime)
+            else:
+                state.setPosition(target)
+                self.persistState(shutterId, state)
+
+    # A motion has ended, by reaching its target, a stop or another command. The
+    # motor ran until endTime or until it reached the target, whichever came first.
+    def motionEnded(self, shutterId, motion, position, endTime):
+        runTime = max(0, endTime - motion.lastCommandTime)
+        if motion.motionCurve != None:
+            runTime = min(runTime, motion.motionCurve.travelTime(motion.position, motion.motionTarget))
+        self.history.record(shutterId, time.time() - (time.monotonic() - motion.lastCommandTime), motion.source, motion.lastCommandDirection, motion.position, motion.motionTarget, position, motion.wait, runTime)
+
+    # Calibrated travel of the shutter, see TravelCurve
+    def getTravelCurve(self, shutterId, direction):
+        return self.config.Shutters[shutterId]['curveDown' if direction == 'down' else 'curveUp']
+
+    # True if the shutter going direction has still to travel to reach position
+    def isAhead(self, shutterId, direction, position, now = None):
+        livePosition = self.getShutterState(shutterId).getLivePosition(now)
+        return (livePosition == None) or (self.getTravelCurve(shutterId, direction).travelTime(livePosition, position) > 0)
+
+    # Future of a command which is not sent, its result is False
+    def notSent(self):
+        future = Future()
+        future.set_result(False)
+        return future
+
+    # Starts a motion and the reports of the intermediate positions. Returns
+    # the time left until the target is reached and the time of the command.
+    # Callers scheduling the end of the motion hold the lock of the state, so
+    # the deadline of a newer command cannot be replaced by theirs.
+    # requestTime is when the command was asked for, source who asked for it
+    def startMotion(self, shutterId, direction, target, partial = False, startTime = None, source = None, requestTime = None):
         state = self.getShutterState(shutterId)
-        oldLastCommandTime = state.lastCommandTime
-
+        with state.lock:
+            self.motionTracker.cancel(shutterId)
+            curve = self.getTravelCurve(shutterId, direction)
+            if startTime == None:
+                startTime = time.monotonic()
+            wait = max(0, startTime - requestTime) if requestTime != None else None
+            motion = state.registerCommand(direction, curve, target, partial, startTime, source, wait)
+            self.persistState(shutterId, state)
+            self.motionTracker.schedule(('progress', shutterId), self.positionReportInterval, self.reportProgress, shutterId, motion.lastCommandTime)
+            return curve.travelTime(motion.position, target) - (time.monotonic() - motion.lastCommandTime), motion.lastCommandTime
+
+    # Reports the live position while the motion started at commandTime goes on
+    def reportProgress(self, shutterId, commandTime):
+        state = self.getShutterState(shutterId)
+        motion = state.motion
+        now = time.monotonic()
+        if (motion.lastCommandTime != commandTime) or not state.isMoving(now, motion):
+            return
+        self.events.publish(shutterId, state.getLivePosition(now, motion))
+        self.motionTracker.schedule(('progress', shutterId), self.positionReportInterval, self.reportProgress, shutterId, commandTime)
+
+    # Sets the final position once the operation is expected to be complete. A
+    # later command for the shutter replaces the deadline.
+    def trackMotion(self, shutterId, timeToWait, newPosition, commandTime):
         self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Waiting for operation to complete for " + str(timeToWait) + " seconds")
-        time.sleep(timeToWait)
+        self.motionTracker.schedule(shutterId, timeToWait, self.setFinalPosition, shutterId, commandTime, newPosition)
 
+    def setFinalPosition(self, shutterId, commandTime, newPosition):
         # Only set new position if registerCommand has not been called in between
-        if state.lastCommandTime == oldLastCommandTime:
+        if self.setPosition(shutterId, newPosition, commandTime):
             self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Set new final position: " + str(newPosition))
-            self.setPosition(shutterId, newPosition)
         else:
-            self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Discard final position. Position is now: " + str(state.position))
+            self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Discard final position. Position is now: " + str(self.getShutterState(shutterId).position))
+
+    # Runs function(*args) once the command of the future has been sent.
+    # Returns the future, so callers can wait for the transmission if they need to.
+    def afterCommand(self, future, function, *args):
+        def done(f):
+            if f.cancelled() or (f.exception() != None):
+                self.LogError("Command not sent, state not updated: " + str(None if f.cancelled() else f.exception()))
+                return
+            try:
+                function(*args)
+            except Exception as e1:
+                self.LogError("Error updating shutter state: " + str(e1))
+                self.LogError(traceback.format_exc())
+        future.add_done_callback(done)
+        return future
 
-    def lower(self, shutterId):
-        state = self.getShutterState(shutterId, 100)
+    def moveStarted(self, shutterId, direction, source = None, requestTime = None):
+        finalPosition = 0 if direction == 'down' else 100
+        with self.getShutterState(shutterId).lock:
+            timeToWait, commandTime = self.startMotion(shutterId, direction, finalPosition, source = source, requestTime = requestTime)
 
-        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down")
-        self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        state.registerCommand('down')
+            # wait and set final position only if not interrupted in between
+            self.trackMotion(shutterId, timeToWait, finalPosition, commandTime)
 
-        # wait and set final position only if not interrupted in between
-        timeToWait = state.position/100*self.config.Shutters[shutterId]['durationDown']
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, 0))
-        t.start()
+    def lower(self, shutterId, priority = priorityInteractive, source = None):
+        self.getShutterState(shutterId, 100)
 
-    def lowerPartial(self, shutterId, percentage):
-        state = self.getShutterState(shutterId, 100)
+        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down")
+        requestTime = time.monotonic()
+        return self.sendGroup([shutterId], self.buttonDown, priority, self.moveStarted, 'down', source, requestTime)
 
-        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down") 
-        self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        state.registerCommand('down')
-        time.sleep((state.position-percentage)/100*self.config.Shutters[shutterId]['durationDown'])
-        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stop at partial position requested")
-        self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
+    def lowerPartial(self, shutterId, percentage, priority = priorityInteractive, source = None):
+        self.getShutterState(shutterId, 100)
+        if not self.isAhead(shutterId, 'down', percentage):
+            self.LogWarn("["+self.config.Shutters[shutterId]['name']+"] Already at or below " + str(percentage) + ", not moving")
+            return self.notSent()
 
-        self.setPosition(shutterId, percentage)
+        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down") 
+        requestTime = time.monotonic()
+        future = self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat, priority)
+        return self.movePartial(future, shutterId, 'down', percentage, source, requestTime)
 
-    def rise(self, shutterId):
-        state = self.getShutterState(shutterId, 0)
+    def rise(self, shutterId, priority = priorityInteractive, source = None):
+        self.getShutterState(shutterId, 0)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going up")
-        self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        state.registerCommand('up')
-
-        # wait and set final position only if not interrupted in between
-        timeToWait = (100-state.position)/100*self.config.Shutters[shutterId]['durationUp']
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, 100))
-        t.start()
+        requestTime = time.monotonic()
+        return self.sendGroup([shutterId], self.buttonUp, priority, self.moveStarted, 'up', source, requestTime)
 
-    def risePartial(self, shutterId, percentage):
-        state = self.getShutterState(shutterId, 0)
+    def risePartial(self, shutterId, percentage, priority = priorityInteractive, source = None):
+        self.getShutterState(shutterId, 0)
+        if not self.isAhead(shutterId, 'up', percentage):
+            self.LogWarn("["+self.config.Shutters[shutterId]['name']+"] Already at or above " + str(percentage) + ", not moving")
+            return self.notSent()
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going up")
-        self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        state.registerCommand('up')
-        time.sleep((percentage-state.position)/100*self.config.Shutters[shutterId]['durationUp'])
-        self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stop at partial position requested")
-        self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
-
-        self.setPosition(shutterId, percentage)
+        requestTime = time.monotonic()
+        future = self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat, priority)
+        return self.movePartial(future, shutterId, 'up', percentage, source, requestTime)
+
+    # Once the move has been sent, the stop is scheduled at the time the
+    # requested position is reached; nothing waits in the caller's thread.
+    # Returns a future which completes when the stop has been sent. It is
+    # cancelled if another command for the shutter comes first, its result is
+    # False if the move was dropped for a command of higher priority. If the
+    # shutter passed the target while the command waited for the radio, it
+    # is stopped right away where it is.
+    def movePartial(self, future, shutterId, direction, percentage, source = None, requestTime = None):
+        stopFuture = Future()
+        def done(f):
+            if f.cancelled() or (f.exception() != None):
+                self.LogError("Command not sent, state not updated: " + str(None if f.cancelled() else f.exception()))
+                if stopFuture.set_running_or_notify_cancel():
+                    stopFuture.set_exception(Exception("Command not sent") if f.cancelled() else f.exception())
+                return
+            if shutterId not in f.result():
+                # dropped for a command of higher priority, nothing moved
+                if stopFuture.set_running_or_notify_cancel():
+                    stopFuture.set_result(False)
+                return
+            state = self.getShutterState(shutterId)
+            with state.lock:
+                # one clock reading, the shutter must not pass the target between the check and the start
+                now = time.monotonic()
+                target = percentage
+                if not self.isAhead(shutterId, direction, target, now):
+                    target = state.getLivePosition(now)
+                    self.LogWarn("["+self.config.Shutters[shutterId]['name']+"] Already past " + str(percentage) + ", stopping at " + "%.1f" % target)
+                timeToWait, commandTime = self.startMotion(shutterId, direction, target, partial = True, startTime = now, source = source, requestTime = requestTime)
+                self.motionTracker.schedule(shutterId, timeToWait, self.stopPartials, [(shutterId, commandTime, target, stopFuture)], onCancel = stopFuture.cancel)
+        future.add_done_callback(done)
+        return stopFuture
+
+    # Sends the stops of partial moves, stops is a list of (shutterId,
+    # commandTime, position, stopFuture). A shutter which got another command
+    # since commandTime is left alone and its future cancelled. The stops go
+    # out in one burst per radio, at interactive priority so no scheduled move
+    # waiting for the radio delays them.
+    def stopPartials(self, stops):
+        due = []
+        for shutterId, commandTime, percentage, stopFuture in stops:
+            if self.getShutterState(shutterId).lastCommandTime != commandTime:
+                stopFuture.cancel()
+                continue
+            self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stop at partial position requested")
+            due.append((shutterId, commandTime, percentage, stopFuture))
+        if len(due) == 0:
+            return
+        future = self.sendCommands([(stop[0], self.buttonStop, self.config.SendRepeat) for stop in due], self.priorityInteractive)
+        def done(f):
+            failed = f.cancelled() or (f.exception() != None)
+            if failed:
+                self.LogError("Command not sent, state not updated: " + str(None if f.cancelled() else f.exception()))
+            for shutterId, commandTime, percentage, stopFuture in due:
+                if not failed:
+                    self.setPosition(shutterId, percentage, commandTime)
+                if not stopFuture.set_running_or_notify_cancel():
+                    continue
+                if failed:
+                    stopFuture.set_exception(Exception("Command not sent") if f.cancelled() else f.exception())
+                else:
+                    stopFuture.set_result(None)
+        future.add_done_callback(done)
 
-    def stop(self, shutterId):
-        state = self.getShutterState(shutterId, 50)
+    def stop(self, shutterId, priority = priorityInteractive, source = None):
+        self.getShutterState(shutterId, 50)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stopping")
-        self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
-
-        self.LogDebug("["+shutterId+"] Previous position: " + str(state.position))
-        secondsSinceLastCommand = int(round(time.monotonic() - state.lastCommandTime))
-        self.LogDebug("["+shutterId+"] Seconds since last command: " + str(secondsSinceLastCommand))
-
-        # Compute position based on time elapsed since last command & command direction
-        setupDurationDown = self.config.Shutters[shutterId]['durationDown']
-        setupDurationUp = self.config.Shutters[shutterId]['durationUp']
-
-        fallback = False
-        if state.lastCommandDirection == 'up':
-          if secondsSinceLastCommand > 0 and secondsSinceLastCommand < setupDurationUp:
-            durationPercentage = int(round(secondsSinceLastCommand/setupDurationUp * 100))
-            self.LogDebug("["+shutterId+"] Up duration percentage: " + str(durationPercentage) + ", State position: "+ str(state.position))
-            if state.position > 0: # after rise from previous position
-                newPosition = min (100 , state.position + durationPercentage)
-            else: # after rise from fully closed
-                newPosition = durationPercentage
-          else:  #fallback
-            self.LogWarn("["+shutterId+"] Too much time since up command.")
-            fallback = True
-        elif state.lastCommandDirection == 'down':
-          if secondsSinceLastCommand > 0 and secondsSinceLastCommand < setupDurationDown:
-            durationPercentage = int(round(secondsSinceLastCommand/setupDurationDown * 100))
-            self.LogDebug("["+shutterId+"] Down duration percentage: " + str(durationPercentage) + ", State position: "+ str(state.position))
-            if state.position < 100: # after lower from previous position
-                newPosition = max (0 , state.position - durationPercentage)
-            else: # after down from fully opened
-                newPosition = 100 - durationPercentage
-          else:  #fallback
-            self.LogWarn("["+shutterId+"] Too much time since down command.")
-            fallback = True
-        else: # consecutive stops
-            self.LogWarn("["+shutterId+"] Stop pressed while stationary.")
-            fallback = True
-
-        if fallback == True: # Let's assume it will end on the intermediate position ! If it exists !
-            intermediatePosition = self.config.Shutters[shutterId]['intermediatePosition']
-            if (intermediatePosition == None) or (intermediatePosition == state.position):
-                self.LogInfo("["+shutterId+"] Stay stationary.")
-                newPosition = state.position
+        requestTime = time.monotonic()
+        return self.sendGroup([shutterId], self.buttonStop, priority, self.stopped, source, requestTime)
+
+    def stopped(self, shutterId, source = None, requestTime = None):
+        state = self.getShutterState(shutterId)
+        # no other command of this shutter may come in between reading the motion and ending it
+        with state.lock:
+            self.motionTracker.cancel(shutterId)
+            motion = state.motion
+            now = time.monotonic()
+
+            self.LogDebug("["+shutterId+"] Previous position: " + str(motion.position))
+            self.LogDebug("["+shutterId+"] Seconds since last command: " + "%.2f" % (now - motion.lastCommandTime))
+
+            # Compute position based on time elapsed since last command & command direction
+            if state.isMoving(now, motion):
+                newPosition = state.getLivePosition(now, motion)
+                self.LogDebug("["+shutterId+"] Stopped while going " + motion.lastCommandDirection + " at position: " + "%.1f" % newPosition)
             else:
-                self.LogInfo("["+shutterId+"] Motor expected to move to intermediate position "+str(intermediatePosition))
-                if state.position > intermediatePosition:
-                    state.registerCommand('down')
-                    timeToWait = abs(state.position - intermediatePosition) / 100*self.config.Shutters[shutterId]['durationDown']
+                if motion.lastCommandDirection == None: # consecutive stops
+                    self.LogWarn("["+shutterId+"] Stop pressed while stationary.")
                 else:
-                    state.registerCommand('up')
-                    timeToWait = abs(state.position - intermediatePosition) / 100*self.config.Shutters[shutterId]['durationUp']
-                # wait and set final intermediate position only if not interrupted in between
-                t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, intermediatePosition))
-                t.start()
-                return
-
-        # Save computed position
-        self.setPosition(shutterId, newPosition)
+                    self.LogWarn("["+shutterId+"] Too much time since " + motion.lastCommandDirection + " command.")
+
+                # Let's assume it will end on the intermediate position ! If it exists !
+                position = state.getLivePosition(now, motion)
+                intermediatePosition = self.config.Shutters[shutterId]['intermediatePosition']
+                if (intermediatePosition == None) or (intermediatePosition == position):
+                    self.LogInfo("["+shutterId+"] Stay stationary.")
+                    newPosition = position
+                else:
+                    self.LogInfo("["+shutterId+"] Motor expected to move to intermediate position "+str(intermediatePosition))
+                    timeToWait, commandTime = self.startMotion(shutterId, 'down' if position > intermediatePosition else 'up', intermediatePosition, source = source, requestTime = requestTime)
+                    # wait and set final intermediate position only if not interrupted in between
+                    self.trackMotion(shutterId, timeToWait, intermediatePosition, commandTime)
+                    return
+
+            # End the motion, then save computed position
+            state.registerCommand(None)
+            self.setPosition(shutterId, newPosition)
 
-        # Register command at the end to not impact the lastCommand timer
-        state.registerCommand(None)
+    # Send the same button to several shutters in one radio burst, then call
+    # function(shutterId, *args) for those whose frame was sent
+    def sendGroup(self, shutterIds, button, priority, function, *args):
+        shutterIds = list(shutterIds)
+        future = self.sendCommands([(shutterId, button, self.config.SendRepeat) for shutterId in shutterIds], priority)
+        def update():
+            for shutterId in shutterIds:
+                if shutterId in future.result():
+                    function(shutterId, *args)
+        return self.afterCommand(future, update)
+
+    def lowerGroup(self, shutterIds, priority = priorityInteractive, source = None):
+        for shutterId in shutterIds:
+            self.getShutterState(shutterId, 100)
+            self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down")
+        return self.sendGroup(shutterIds, self.buttonDown, priority, self.moveStarted, 'down', source, time.monotonic())
+
+    def riseGroup(self, shutterIds, priority = priorityInteractive, source = None):
+        for shutterId in shutterIds:
+            self.getShutterState(shutterId, 0)
+            self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going up")
+        return self.sendGroup(shutterIds, self.buttonUp, priority, self.moveStarted, 'up', source, time.monotonic())
+
+    def stopGroup(self, shutterIds, priority = priorityInteractive, source = None):
+        for shutterId in shutterIds:
+            self.getShutterState(shutterId, 50)
+            self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stopping")
+        return self.sendGroup(shutterIds, self.buttonStop, priority, self.stopped, source, time.monotonic())
+
+    # Drives several shutters to their target positions at once, targets is
+    # {shutterId: position}. The start frames go out in one burst per radio,
+    # then the stop of each shutter moving to an intermediate position is sent
+    # at its own deadline from the motion tracker, so the scene takes the time
+    # of the slowest motor. Returns a future which completes once the last
+    # frame of every shutter has been sent; it is cancelled if another command
+    # for one of them comes first.
+    def moveScene(self, targets, priority = priorityInteractive, source = None):
+        requestTime = time.monotonic()
+        bursts = {}
+        for shutterId, target in targets.items():
+            target = min(100, max(0, target))
+            # an unknown position is assumed to be the farthest from the target
+            state = self.getShutterState(shutterId, 100 if target < 50 else 0)
+            position = state.getLivePosition()
+            if abs(position - target) < 0.5 and not state.isMoving():
+                self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Already at " + str(target))
+                continue
+            direction = 'down' if target < position else 'up'
+            self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going " + direction + " to " + str(target))
+            bursts.setdefault(self.getRadio(shutterId), []).append((shutterId, direction, target))
+
+        futures = []
+        for radio, moves in bursts.items():
+            future = self.sendCommands([(shutterId, self.buttonDown if direction == 'down' else self.buttonUp, self.config.SendRepeat) for shutterId, direction, target in moves], priority)
+            stopFutures = [Future() if target not in (0, 100) else None for shutterId, direction, target in moves]
+            future.add_done_callback(functools.partial(self.sceneStarted, radio, moves, stopFutures, source, requestTime))
+            futures += [future] + [stopFuture for stopFuture in stopFutures if stopFuture != None]
+        if len(futures) == 0:
+            future = Future()
+            future.set_result([])
+            return future
+        return gatherFutures(futures)
+
+    # The start frames of a scene have been sent on the radio. Each shutter
+    # started when its own frame was on the air, the later frames of the burst
+    # are taken off its start time.
+    def sceneStarted(self, radio, moves, stopFutures, source, requestTime, future):
+        if future.cancelled() or (future.exception() != None):
+            self.LogError("Command not sent, state not updated: " + str(None if future.cancelled() else future.exception()))
+            for stopFuture in stopFutures:
+                if (stopFuture != None) and stopFuture.set_running_or_notify_cancel():
+                    stopFuture.set_exception(Exception("Command not sent") if future.cancelled() else future.exception())
+            return
+
+        # moves dropped for a command of higher priority were not sent
+        for index, (shutterId, direction, target) in enumerate(moves):
+            if (shutterId not in future.result()) and (stopFutures[index] != None) and stopFutures[index].set_running_or_notify_cancel():
+                stopFutures[index].set_result(False)
+        sent = [index for index, move in enumerate(moves) if move[0] in future.result()]
+
+        now = time.monotonic()
+        frameTime = radio.encoder.duration(self.config.SendRepeat) / 1e6
+        stops = []
+        for position, index in enumerate(sent):
+            shutterId, direction, target = moves[index]
+            startTime = now - (len(sent) - 1 - position) * frameTime
+            state = self.getShutterState(shutterId)
+            with state.lock:
+                if (stopFutures[index] != None) and not self.isAhead(shutterId, direction, target, startTime):
+                    # passed the target while the frames waited for the radio
+                    target = state.getLivePosition(startTime)
+                timeToWait, commandTime = self.startMotion(shutterId, direction, target, partial = stopFutures[index] != None, startTime = startTime, source = source, requestTime = requestTime)
+                if stopFutures[index] == None:
+                    self.trackMotion(shutterId, timeToWait, target, commandTime)
+                else:
+                    stops.append((now + timeToWait, shutterId, commandTime, target, stopFutures[index]))
+
+        # A stop due while the frames of an earlier one are still on the air
+        # would wait for them anyway, it is sent in the same burst
+        stops.sort(key = lambda stop: stop[0])
+        while len(stops):
+            group = [stops.pop(0)]
+            while len(stops) and (stops[0][0] <= group[0][0] + len(group) * frameTime):
+                group.append(stops.pop(0))
+            stopFutures = [stop[4] for stop in group]
+            def cancel(stopFutures = stopFutures):
+                for stopFuture in stopFutures:
+                    stopFuture.cancel()
+            self.motionTracker.schedule(('scene', group[0][1], group[0][2]), group[0][0] - time.monotonic(), self.stopPartials, [stop[1:] for stop in group], onCancel = cancel)
 
     # Push a set of buttons for a short or long press.
     def pressButtons(self, shutterId, buttons, longPress):
-        self.sendCommand(shutterId, buttons, 35 if longPress else 1)
+        return self.sendCommand(shutterId, buttons, 35 if longPress else 1)
 
     def program(self, shutterId):
-        self.sendCommand(shutterId, self.buttonProg, 1)
+        return self.sendCommand(shutterId, self.buttonProg, 1)
 
+    # callbackFunction(shutterId, position) is called on every position change,
+    # from the event bus thread
     def registerCallBack(self, callbackFunction):
-        self.callback.append(callbackFunction)
+        self.events.subscribe(callbackFunction)
+
+    def getStatistics(self):
+        return {'radios': self.radios.getStatistics(), 'transmit': self.transmitStatistics.getStatistics(), 'rollingCodes': self.config.CodeStore.getStatistics(), 'motion': self.motionTracker.getStatistics(), 'positions': self.positionStore.getStatistics(), 'events': self.events.getStatistics(), 'history': self.history.getStatistics(),
+                'prerender': {'hits': self.prerenderHits, 'misses': self.prerenderMisses, 'frames': len(self.prerendered), 'uploadedPulses': self.prerenderedPulses}}
+
+    def close(self):
+        self.motionTracker.stop()
+        self.radios.stop()
+        self.positionStore.close()
+        self.history.close()
+        self.events.close()
+        for shutterId in set(key[0] for key in self.prerendered):
+            self.releasePrerendered(shutterId)
+        self.radios.close()
+
+    # Radio sending the frames of this shutter
+    def getRadio(self, shutterId):
+        return self.radios.get(self.config.Shutters[shutterId].get('radio'))
+
+    # Queues the frame for the radio thread and returns a concurrent.futures.Future
+    # which completes once the frame has been sent. Commands with a lower priority
+    # value are sent first, a stop pressed in the web UI overtakes scheduled moves.
+    def sendCommand(self, shutterId, button, repetition, priority = priorityInteractive):
+        return self.sendCommands([(shutterId, button, repetition)], priority)
+
+    # Same as sendCommand for a list of (shutterId, button, repetition). The frames
+    # of each radio are sent back to back in a single burst, the radios send
+    # in parallel. The frames of these shutters still waiting in a burst of
+    # lower priority are dropped: sent after these ones, they would undo them
+    # (the down of a scheduled burst after an interactive stop). The result of
+    # the future is the set of shutters whose frames were sent.
+    def sendCommands(self, commands, priority = priorityInteractive):
+        shutterIds = set(command[0] for command in commands)
+        dropped = set()
+        jobs = {}
+        for command in commands:
+            jobs.setdefault(self.getRadio(command[0]), []).append(command)
+        with self.pendingLock:
+            for burst in self.pendingBursts:
+                if burst[0] > priority:
+                    for command in burst[1]:
+                        if command[0] in shutterIds:
+                            self.LogInfo("["+self.config.Shutters[command[0]]['name']+"] Queued frame dropped for a command of higher priority")
+                            burst[2].add(command[0])
+                    burst[1][:] = [command for command in burst[1] if command[0] not in shutterIds]
+            bursts = [[priority, radioCommands, dropped] for radioCommands in jobs.values()]
+            self.pendingBursts = self.pendingBursts + bursts
+        radioFuture = self.radios.submit([(radio, self.transmit, (radio, burst)) for radio, burst in zip(jobs, bursts)], priority)
+
+        future = Future()
+        def done(f):
+            with self.pendingLock:
+                self.pendingBursts = [burst for burst in self.pendingBursts if all(burst is not own for own in bursts)]
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() != None:
+                future.set_exception(f.exception())
+            else:
+                future.set_result(shutterIds - dropped)
+        radioFuture.add_done_callback(done)
+        return future
 
-    def sendCommand(self, shutterId, button, repetition): #Sending a frame
+    def transmit(self, radio, burst): #Sending frames
     # Sending more than two repetitions after the original frame means a button kept pressed and moves the blind in steps 
     # to adjust the tilt. Sending the original frame and three repetitions is the smallest adjustment, sending the original
     # frame and more repetitions moves the blinds up/down for a longer time.
     # To activate the program mode (to register or de-register additional remotes) of your Somfy blinds, long press the 
     # prog button (at least thirteen times after the original frame to activate the registration.
-       self.LogDebug("sendCommand: Waiting for Lock")
-       self.lock.acquire()
+       # from now on the burst is sent as it is
+       with self.pendingLock:
+           self.pendingBursts = [pending for pending in self.pendingBursts if pending is not burst]
+           commands = list(burst[1])
+       if len(commands) == 0:
+           return
+       startTime = time.monotonic()
+       startCpuTime = time.thread_time()
+
+       # advance all rolling codes in one step, before anything is sent
+       codes = {}
+       frames = []
+       for shutterId, button, repetition in commands:
+           code = codes.get(shutterId, int(self.config.Shutters[shutterId]['code']))
+           codes[shutterId] = code + 1
+           frames.append((shutterId, button, repetition, code))
+       self.config.setCodes(codes)
+
+       waves = []
+       airTime = 0
+       for shutterId, button, repetition, code in frames:
+           prerendered = self.getPrerendered(radio, shutterId, button, code)
+           if prerendered != None:
+               frame, looped = prerendered
+               with self.prerenderLock:
+                   self.prerenderHits += 1
+           else:
+               #This is where all the awesomeness is happening. You're telling the daemon what you wanna send
+               frame = self.buildFrame(shutterId, button, code)
+               looped = radio.encoder.renderLoop(frame, repetition)
+               with self.prerenderLock:
+                   self.prerenderMisses += 1
+           if self.frameTrace.enabled:
+               self.frameTrace.record(shutterId, button, code, repetition, frame)
+           # the repeats are looped by the transmitter, only two waves per frame
+           waves.append((looped._replace(repeats = repetition - 1), radio.encoder.duration(repetition)))
+           airTime += radio.encoder.duration(repetition)
        try:
-           self.LogDebug("sendCommand: Lock aquired")
-           checksum = 0
-
-           teleco = int(shutterId, 16)
-           code = int(self.config.Shutters[shutterId]['code'])
-
-           # print (codecs.encode(shutterId, 'hex_codec'))
-           self.config.setCode(shutterId, code+1)
-
-           pi = pigpio.pi() # connect to Pi
-
-           if not pi.connected:
-              exit()
-
-           pi.wave_add_new()
-           pi.set_mode(self.TXGPIO, pigpio.OUTPUT)
-
-           self.LogInfo ("Remote  :      " + "0x%0.2X" % teleco + ' (' + self.config.Shutters[shutterId]['name'] + ')')
-           self.LogInfo ("Button  :      " + "0x%0.2X" % button)
-           self.LogInfo ("Rolling code : " + str(code))
-           self.LogInfo ("")
-
-           self.frame[0] = 0xA7;       # Encryption key. Doesn't matter much
-           self.frame[1] = button << 4 # Which button did  you press? The 4 LSB will be the checksum
-           self.frame[2] = code >> 8               # Rolling code (big endian)
-           self.frame[3] = (code & 0xFF)           # Rolling code
-           self.frame[4] = teleco >> 16            # Remote address
-           self.frame[5] = ((teleco >>  8) & 0xFF) # Remote address
-           self.frame[6] = (teleco & 0xFF)         # Remote address
-
-           outstring = "Frame  :    "
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           for i in range(0, 7):
-              checksum = checksum ^ self.frame[i] ^ (self.frame[i] >> 4)
-
-           checksum &= 0b1111; # We keep the last 4 bits only
-
-           self.frame[1] |= checksum;
-
-           outstring = "With cks  : "
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           for i in range(1, 7):
-              self.frame[i] ^= self.frame[i-1];
-
-           outstring = "Obfuscated :"
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           #This is where all the awesomeness is happening. You're telling the daemon what you wanna send
-           wf=[]
-           wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 9415)) # wake up pulse
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 89565)) # silence
-           for i in range(2): # hardware synchronization
-              wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-              wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-           wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-           for i in range (0, 56): # manchester enconding of payload data
-              if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                 wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                 wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-              else:
-                 wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                 wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-
-           for j in range(1,repetition): # repeating frames
-                    for i in range(7): # hardware synchronization
-                          wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-                          wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-                    wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-                    for i in range (0, 56): # manchester enconding of payload data
-                          if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                             wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                             wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                          else:
-                             wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                             wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-
-           pi.wave_add_generic(wf)
-           wid = pi.wave_create()
-           #pi.wave_send_once(wid)
-           #while pi.wave_tx_busy():
-           #   pass
-           with cc1101.CC1101() as transceiver:
-                transceiver.set_base_frequency_hertz(433.42e6)
-                transceiver._write_burst(start_register=0x3E, values=[0x0, 0x34])    
-                with transceiver.asynchronous_transmission():
-                    pi.wave_send_once(wid)
-                    while pi.wave_tx_busy():
-                        pass
-
-           pi.wave_delete(wid)
-
-           pi.stop()
+           radio.transmitter.send(waves)
        finally:
-           self.lock.release()
-           self.LogDebug("sendCommand: Lock released")
+           # the codes moved on, what was rendered for these shutters is stale
+           for shutterId in codes:
+               self.releasePrerendered(shutterId)
+       self.transmitStatistics.record(time.thread_time() - startCpuTime, airTime / 1e6, time.monotonic() - startTime)
+
+    def buildFrame(self, shutterId, button, code):
+       frame = RTSEncoder.buildFrame(button, code, int(shutterId, 16))
+       RTSEncoder.obfuscate(RTSEncoder.addChecksum(frame))
+       return frame
+
+    # Returns (frame, LoopedWave of pulses or uploaded waves) rendered in advance
+    # for this command, or None if there is none or it is not for this code
+    # anymore. The repeats are looped when sending, so it does for any repetition.
+    def getPrerendered(self, radio, shutterId, button, code):
+       entry = self.prerendered.get((shutterId, button))
+       if (entry == None) or (entry['code'] != code) or (entry['radio'] is not radio):
+           return None
+       if entry['handles'] != None:
+           if not all(radio.transmitter.isValid(handle) for handle in entry['handles'][:2]):
+               return None
+           return entry['frame'], entry['handles']
+       return entry['frame'], entry['wave']
+
+    def releasePrerendered(self, shutterId):
+       for button in self.prerenderButtons:
+           entry = self.prerendered.pop((shutterId, button), None)
+           if (entry != None) and (entry['handles'] != None):
+               for handle in entry['handles'][:2]:
+                   entry['radio'].transmitter.release(handle)
+               with self.prerenderLock:
+                   self.prerenderedPulses -= entry['pulses']
+
+    # Called by the thread of a radio while it has nothing to send. Renders the
+    # first and the repeat frame of the next up/down/stop command of one of its
+    # shutters, and uploads them while the wave memory budget (shared by all
+    # radios) allows, so a press only has to send them. Returns True while there
+    # are more frames to render.
+    def prerender(self, name):
+       radio = self.radios.get(name)
+       for key, entry in list(self.prerendered.items()):
+           if (entry['radio'] is radio) and ((key[0] not in self.config.Shutters) or (self.getRadio(key[0]) is not radio)):
+               self.releasePrerendered(key[0])
+
+       for shutterId in list(self.config.Shutters):
+           if self.getRadio(shutterId) is not radio:
+               continue
+           code = int(self.config.Shutters[shutterId]['code'])
+           if all(self.getPrerendered(radio, shutterId, button, code) != None for button in self.prerenderButtons):
+               continue
+           self.releasePrerendered(shutterId)
+           for button in self.prerenderButtons:
+               frame = self.buildFrame(shutterId, button, code)
+               looped = radio.encoder.renderLoop(frame, 1)
+               pulses = len(looped.first) + len(looped.repeat)
+               with self.prerenderLock:
+                   upload = self.prerenderedPulses + pulses <= self.maxPrerenderedPulses
+                   if upload:
+                       self.prerenderedPulses += pulses
+               handles = None
+               if upload:
+                   try:
+                       first = radio.transmitter.upload(looped.first)
+                       try:
+                           handles = looped._replace(first = first, repeat = radio.transmitter.upload(looped.repeat))
+                       except Exception:
+                           radio.transmitter.release(first)
+                           raise
+                   except Exception:
+                       with self.prerenderLock:
+                           self.prerenderedPulses -= pulses
+                       raise
+               self.prerendered[(shutterId, button)] = {'radio': radio, 'code': code, 'frame': frame, 'wave': looped, 'pulses': pulses, 'handles': handles}
+           return True
+       return False
 
 class operateShutters(MyLog):
 
@@ -352,6 +804,7 @@ class operateShutters(MyLog):
         self.log = None
         self.IsStopping = False
         self.ProgramComplete = False
+        self.ExitCode = 0
 
         if args.ConfigFile == None:
             self.ConfigFile = "/etc/operateShutters.conf"
@@ -381,6 +834,11 @@ class operateShutters(MyLog):
             self.LogConsole("Failure to load configuration parameters")
             sys.exit(1)
 
+        if args.trace == True:
+            self.config.TraceFrames = True
+        if args.simulate == True:
+            self.config.Transmitter = "simulated"
+
         # log errors in this module to a file
         self.log = SetupLogger("shutters", self.config.LogLocation + "operateShutters.log")
         self.config.log = self.log
@@ -389,12 +847,14 @@ class operateShutters(MyLog):
             self.LogWarn("operateShutters.py is already loaded.")
             sys.exit(1)
 
-        if not self.startPIGPIO():
+        self.shutter = Shutter(log = self.log, config = self.config)
+
+        if self.config.Transmitter == "simulated":
+            self.shutter.radios.open()
+        elif not self.startPIGPIO():
             self.LogConsole("Not able to start PIGPIO")
             sys.exit(1)
 
-        self.shutter = Shutter(log = self.log, config = self.config)
-
         # atexit.register(self.Close)
         # signal.signal(signal.SIGTERM, self.Close)
         # signal.signal(signal.SIGINT, self.Close)
@@ -402,6 +862,8 @@ class operateShutters(MyLog):
         self.schedule = Schedule(log = self.log, config = self.config)
         self.scheduler = None
         self.webServer = None
+        self.alexa = None
+        self.mqtt = None
 
         if (args.echo == True):
             self.alexa = Alexa(kwargs={'log':self.log, 'shutter': self.shutter, 'config': self.config})
@@ -451,15 +913,12 @@ class operateShutters(MyLog):
            self.LogInfo ("pigpiod is running, process ID is {} ".format(pigpiod_process))
 
            try:
-               pi = pigpio.pi()  # local GPIO only
-               if not pi.connected:
-                   self.LogError("pigpio connection could not be established. Check logs to get more details.")
-                   return False
-               else:
-                   self.LogInfo("pigpio's pi instantiated.")
+               self.shutter.radios.open()  # local GPIO only, kept open for all transmissions
+               self.LogInfo("pigpio's pi instantiated.")
            except Exception as e:
                start_pigpiod_exception = str(e)
                self.LogError("problem instantiating pi: {}".format(start_pigpiod_exception))
+               return False
        else:
            self.LogError("start pigpiod was unsuccessful.")
            return False
@@ -473,19 +932,19 @@ class operateShutters(MyLog):
              parser.print_help()
              
        elif ((args.shutterName != "") and (args.down == True)):
-             self.shutter.lower(self.config.ShuttersByName[args.shutterName])
+             self.shutter.lower(self.config.ShuttersByName[args.shutterName], source = 'cli').result()
        elif ((args.shutterName != "") and (args.up == True)):
-             self.shutter.rise(self.config.ShuttersByName[args.shutterName])
+             self.shutter.rise(self.config.ShuttersByName[args.shutterName], source = 'cli').result()
        elif ((args.shutterName != "") and (args.stop == True)):
-             self.shutter.stop(self.config.ShuttersByName[args.shutterName])
+             self.shutter.stop(self.config.ShuttersByName[args.shutterName], source = 'cli').result()
        elif ((args.shutterName != "") and (args.program == True)):
-             self.shutter.program(self.config.ShuttersByName[args.shutterName])
+             self.shutter.program(self.config.ShuttersByName[args.shutterName]).result()
        elif ((args.shutterName != "") and (args.demo == True)):
              self.LogInfo ("lowering shutter for 7 seconds")
-             self.shutter.lowerPartial(self.config.ShuttersByName[args.shutterName], 7)
+             self.shutter.lowerPartial(self.config.ShuttersByName[args.shutterName], 7, source = 'cli').result()
              time.sleep(7)
              self.LogInfo ("rise shutter for 7 seconds")
-             self.shutter.risePartial(self.config.ShuttersByName[args.shutterName], 7)
+             self.shutter.risePartial(self.config.ShuttersByName[args.shutterName], 7, source = 'cli').result()
        elif ((args.shutterName != "") and (args.duskdawn is not None)):
              self.schedule.addRepeatEventBySunrise([self.config.ShuttersByName[args.shutterName]], 'up', args.duskdawn[1], ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
              self.schedule.addRepeatEventBySunset([self.config.ShuttersByName[args.shutterName]], 'down', args.duskdawn[0], ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
@@ -499,6 +958,12 @@ class operateShutters(MyLog):
                  self.mqtt.setDaemon(True)
                  self.mqtt.start()
              self.scheduler.join()
+       elif (args.history == True):
+             self.PrintHistory(self.config.ShuttersByName[args.shutterName] if args.shutterName else None)
+       elif (args.stress is not None):
+             if not self.StressTest(args.stress):
+                 self.LogConsole("Stress test failed")
+                 self.ExitCode = 1
        elif ((args.shutterName != "") and (args.press)):
 
              buttons = 0
@@ -513,7 +978,7 @@ class operateShutters(MyLog):
              for btn in args.press:
                  buttons |= btnMap[btn]
 
-             self.shutter.pressButtons(self.config.ShuttersByName[args.shutterName], buttons, args.long)
+             self.shutter.pressButtons(self.config.ShuttersByName[args.shutterName], buttons, args.long).result()
        elif (args.auto == True):
              self.schedule.loadScheudleFromConfig()
              self.scheduler = Scheduler(kwargs={'log':self.log, 'schedule':self.schedule, 'shutter': self.shutter, 'config': self.config})
@@ -541,9 +1006,138 @@ class operateShutters(MyLog):
            self.alexa.join()
        if (args.mqtt == True):
            self.mqtt.join()
+       if (args.trace == True):
+           for frame in self.shutter.frameTrace.getFrames():
+               self.LogConsole(frame['time'] + "  remote " + frame['remote'] + "  button " + frame['button'] + "  code " + str(frame['code']) + "  repetition " + str(frame['repetition']) + "  frame " + frame['frame'])
        self.LogInfo ("Process Command Completed....")
        self.Close();
 
+    #--------------------- operateShutters::PrintHistory -------------------------------
+    # Dumps the recorded motions of one shutter (or all of them) and their totals
+    def PrintHistory(self, shutterId = None):
+        history = self.shutter.history.getHistory(shutterId)
+        for id, stats in self.shutter.history.getStatistics(shutterId).items():
+            name = self.config.Shutters[id]['name'] if id in self.config.Shutters else id
+            self.LogConsole("[" + name + "] " + str(stats['moves']) + " moves, motor ran " + "%.1f" % stats['runTime'] + " s, average wait " +
+                            ("%.3f s" % stats['averageWait'] if stats['averageWait'] != None else "unknown") + ", " + str(stats['movesPerDay']) + " moves per day, sources " + str(stats['sources']))
+            for motion in history[id]:
+                self.LogConsole("  " + motion['time'] + "  " + "%-9s" % motion['source'] + " " + "%-4s" % motion['direction'] + " " + "%5.1f" % motion['start'] + " -> " + "%5.1f" % motion['end'] + " (target " + "%.1f" % motion['target'] + ")" +
+                                "  ran " + "%.2f" % motion['runTime'] + " s  waited " + ("%.3f s" % motion['wait'] if motion['wait'] != None else "-"))
+
+    #--------------------- operateShutters::StressTest ---------------------------------
+    # Sends random commands to all shutters from several threads for the given
+    # seconds while other threads read the positions, then checks the state is
+    # consistent: positions always known and within 0..100, all commands done,
+    # no motion left pending, each recorded motion ended between its start and
+    # its target and each rolling code advanced once per frame.
+    # Only with the simulated radio, nothing is sent on the air.
+    def StressTest(self, seconds, writers = 8, readers = 4):
+        if self.config.Transmitter != "simulated":
+            self.LogConsole("The stress test can only run with the simulated radio (-simulate)")
+            return False
+
+        shutterIds = list(self.config.Shutters)
+        if len(shutterIds) == 0:
+            self.LogConsole("There is no shutter to run the stress test with")
+            return False
+        startCodes = {shutterId: int(self.config.Shutters[shutterId]['code']) for shutterId in shutterIds}
+        startMoves = {shutterId: stats['moves'] for shutterId, stats in self.shutter.history.getStatistics().items()}
+        lock = threading.Lock()
+        moves = []          # (shutterId, future)
+        partials = []       # (shutterId, future of the stop)
+        errors = []
+        deadline = time.monotonic() + seconds
+
+        def writer(seed):
+            rand = random.Random(seed)
+            while time.monotonic() < deadline:
+                shutterId = rand.choice(shutterIds)
+                action = rand.choice(['lower', 'rise', 'stop', 'lowerPartial', 'risePartial'])
+                if action.endswith('Partial'):
+                    # a target ahead of the shutter, it may still pass it before the command is sent
+                    position = self.shutter.getShutterState(shutterId, 50).getLivePosition()
+                    target = rand.randint(0, int(position)) if action == 'lowerPartial' else rand.randint(int(math.ceil(position)), 100)
+                    future = getattr(self.shutter, action)(shutterId, target)
+                    with lock:
+                        partials.append((shutterId, future))
+                else:
+                    future = getattr(self.shutter, action)(shutterId, rand.choice([self.shutter.priorityInteractive, self.shutter.priorityScheduled]))
+                    with lock:
+                        moves.append((shutterId, future))
+                    # like a user, waits for the frame to be on the air, the radios are the bottleneck
+                    future.exception()
+                time.sleep(rand.uniform(0, 0.02))
+
+        def reader():
+            reads = 0
+            while time.monotonic() < deadline:
+                for shutterId, state in self.shutter.getPositions().items():
+                    if (state['position'] == None) or not (0 <= state['position'] <= 100):
+                        with lock:
+                            errors.append("[" + shutterId + "] Invalid position read: " + str(state['position']))
+                    reads += 1
+            with lock:
+                errors.append(reads)
+
+        threads = [threading.Thread(target = writer, args = (seed,)) for seed in range(writers)] + [threading.Thread(target = reader) for i in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        reads = sum(error for error in errors if isinstance(error, int))
+        errors = [error for error in errors if not isinstance(error, int)]
+
+        # stop everything, then nothing may be left moving
+        for shutterId in shutterIds:
+            moves.append((shutterId, self.shutter.stop(shutterId)))
+        frames = {shutterId: 0 for shutterId in shutterIds}
+        for shutterId, future in moves:
+            try:
+                # not sent if dropped for a command of higher priority
+                if shutterId in future.result(timeout = 60):
+                    frames[shutterId] += 1
+            except Exception as e1:
+                errors.append("[" + shutterId + "] Command not completed: " + repr(e1))
+        for shutterId, future in partials:
+            try:
+                if future.result(timeout = 60) is False:
+                    continue    # already at the target, nothing sent
+                frames[shutterId] += 2
+            except CancelledError:
+                frames[shutterId] += 1  # superseded before its stop was sent
+            except Exception as e1:
+                errors.append("[" + shutterId + "] Partial move not completed: " + repr(e1))
+
+        def pendingMotions():
+            return self.shutter.motionTracker.getStatistics()['pending']
+        # the final stop sends a stationary shutter to its intermediate position
+        travel = max(self.shutter.getTravelCurve(shutterId, direction).duration for shutterId in shutterIds for direction in ('up', 'down'))
+        settle = time.monotonic() + travel + 2 * self.shutter.positionReportInterval
+        while (pendingMotions() != 0) and (time.monotonic() < settle):
+            time.sleep(0.05)
+        if pendingMotions() != 0:
+            errors.append("Motion deadlines left pending: " + str(pendingMotions()))
+        for shutterId, state in self.shutter.getPositions().items():
+            if state['direction'] != None:
+                errors.append("[" + shutterId + "] Still moving " + state['direction'] + " after the final stop")
+        for shutterId in shutterIds:
+            advance = int(self.config.Shutters[shutterId]['code']) - startCodes[shutterId]
+            if advance != frames[shutterId]:
+                errors.append("[" + shutterId + "] Rolling code advanced by " + str(advance) + " for " + str(frames[shutterId]) + " frames")
+
+        # motions of the test, positions are recorded to 0.1
+        for shutterId, stats in self.shutter.history.getStatistics().items():
+            count = min(stats['moves'] - startMoves.get(shutterId, 0), stats['recorded'])
+            for motion in self.shutter.history.getHistory(shutterId)[shutterId][stats['recorded'] - count:]:
+                low, high = (motion['target'], motion['start']) if motion['direction'] == 'down' else (motion['start'], motion['target'])
+                if not (low - 0.11 <= motion['end'] <= high + 0.11):
+                    errors.append("[" + shutterId + "] Motion " + motion['direction'] + " from " + str(motion['start']) + " to " + str(motion['target']) + " ended at " + str(motion['end']))
+
+        for error in errors:
+            self.LogConsole(error)
+        self.LogConsole("Stress test: " + str(len(moves) + len(partials)) + " commands, " + str(sum(frames.values())) + " frames, " + str(reads) + " position reads, " + str(len(errors)) + " errors")
+        return len(errors) == 0
+
     #---------------------operateShutters::Close----------------------------------------
     def Close(self, signum = None, frame = None):
 
@@ -558,8 +1152,8 @@ class operateShutters(MyLog):
         try:
             self.ProgramComplete = True
             if (not self.scheduler == None):
-                self.LogError("Stopping Scheduler. This can take up to 1 second...")
-                self.scheduler.shutdown_flag.set()
+                self.LogError("Stopping Scheduler...")
+                self.scheduler.stop()
                 self.scheduler.join()
                 self.LogError("Scheduler stopped. Now exiting.")
             if (not self.alexa == None):
@@ -576,6 +1170,8 @@ class operateShutters(MyLog):
                 self.LogError("Stopping WebServer. This can take up to 1 second...")
                 self.webServer.shutdown_server()
                 self.LogError("WebServer stopped. Now exiting.")
+            self.shutter.close()
+            self.config.Close()
             sys.exit(0)
         except:
             pass
@@ -597,6 +1193,10 @@ if __name__ == '__main__':
     parser.add_argument('-auto', '-a', help='Run schedule based on config. Also will start up the web-server which can be used to setup the schedule. Try: https://'+socket.gethostname(), action='store_true')
     parser.add_argument('-echo', '-e', help='Enable Amazon Alexa (Echo) integration', action='store_true')
     parser.add_argument('-mqtt', '-m', help='Enable MQTT integration', action='store_true')
+    parser.add_argument('-simulate', help='Use a simulated radio instead of pigpio and the CC1101. Nothing is sent, but frames take the same time as on the air', action='store_true')
+    parser.add_argument('-history', help='Print the recorded motions of the Shutter (of all shutters without a name) and their totals', action='store_true')
+    parser.add_argument('-stress', type=float, metavar='SECONDS', help='Send random commands to all shutters from several threads for the given seconds, then check the shutter states are consistent. Requires -simulate')
+    parser.add_argument('-trace', '-t', help='Record the frames sent and print them when done. In -auto mode they can also be read from the web server (cmd/getFrameTrace)', action='store_true')
     args = parser.parse_args()
 
     #Start things up
@@ -605,6 +1205,6 @@ if __name__ == '__main__':
     try:
         while not MyShutter.ProgramComplete:
             time.sleep(0.01)
-        sys.exit(0)
     except:
         sys.exit(1)
+    sys.exit(MyShutter.ExitCode)